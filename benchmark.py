@@ -0,0 +1,306 @@
+#encoding: utf-8
+# Micro-benchmarks for the simulators. Usage: python benchmark.py [name ...]
+import os
+import sys
+import timeit
+import tempfile
+
+import computer
+import microcode
+import nbitint
+
+
+def bestOf(func, number, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def generatedSource(size=computer.MachineProgram.MAX_ADDRESS + 1):
+    lines = ["# generated program, %i words" % size]
+    operators = ["LOAD", "STORE", "ADD", "SUBTRACT", "LATAA", "JUMPZERO", "LOADI"]
+    for address in range(size):
+        if address % 4 == 3:
+            lines.append("%i %i" % (address, address * 7 % 30000))
+        elif address % 16 == 0:
+            lines.append("%i NOP" % address)
+        else:
+            lines.append("%i %s %i # comment" % (address, operators[address % len(operators)], address % 2048))
+    return "\n".join(lines)
+
+def benchParse():
+    source = generatedSource()
+    lineCount = source.count("\n") + 1
+    seconds = bestOf(lambda: computer.MachineProgram(source), 5)
+    print("parse: %i lines in %.2f ms, %.0f lines/s" % (lineCount, seconds * 1000, lineCount / seconds))
+
+def benchImage():
+    source = generatedSource()
+    image = computer.ProgramImage.fromProgram(computer.MachineProgram(source))
+    path = os.path.join(tempfile.mkdtemp(), "program.img")
+    image.save(path)
+    parse = bestOf(lambda: computer.MachineProgram(source), 5)
+    load = bestOf(lambda: computer.ProgramImage.load(path), 200)
+    mapped = bestOf(lambda: computer.ProgramImage.load(path, memoryMap=True), 200)
+    cache = computer.ProgramCache()
+    cache.get(source)
+    cached = bestOf(lambda: cache.get(source), 20)
+    print("image: parse %.2f ms, load %.1f us, load (mmap) %.1f us, cache hit %.1f us" % (
+        parse * 1000, load * 1e6, mapped * 1e6, cached * 1e6))
+    os.remove(path)
+
+RESET_SOURCE = """
+0 LOAD 100
+1 ADD 101
+2 STORE 102
+3 JUMPNEG 5
+4 JUMP 1
+100 30000
+101 1000
+"""
+
+def benchRestore():
+    program = computer.MachineProgram(RESET_SOURCE)
+    engines = [("MachineSim", computer.MachineSim()),
+               ("MachineSim(sparse)", computer.MachineSim(sparse=True)),
+               ("FastMachineSim", computer.FastMachineSim())]
+    for name, sim in engines:
+        sim.loadProgram(program)
+        snapshot = sim.snapshot()
+        def reload():
+            sim.resetRam()
+            sim.resetRegisters()
+            sim.loadProgram(program)
+        def reloadAndRun():
+            sim.run(reload=True)
+        def restoreAndRun():
+            sim.restore(snapshot)
+            sim.run()
+        print("%-20s reset: reload %8.1f us, restore %8.1f us | with run: reload %8.1f us, restore %8.1f us" % (
+            name, bestOf(reload, 200) * 1e6, bestOf(lambda: sim.restore(snapshot), 200) * 1e6,
+            bestOf(reloadAndRun, 200) * 1e6, bestOf(restoreAndRun, 200) * 1e6))
+
+def linearScanDispatch(sim, oper):
+    # _getOperationFunc before the dispatch table, kept as the baseline
+    try:
+        return [getattr(type(sim), "opr_" + operation) for operation, (bits, func) in computer.MachineSim.OPERATIONS_DEF.items()|computer.MachineSim.OPERATIONS_EXTENDED.items() if int(bits)==int(oper)][0]
+    except:
+        return type(sim).opr_NOP
+
+def benchDispatch():
+    sim = computer.MachineSim()
+    opcodes = range(16)
+    def scan():
+        for oper in opcodes:
+            linearScanDispatch(sim, oper)
+    def table():
+        for oper in opcodes:
+            sim._getOperationFunc(oper)
+    before = bestOf(scan, 2000) / len(opcodes)
+    after = bestOf(table, 2000) / len(opcodes)
+    print("dispatch: linear scan %.3f us, table %.3f us per instruction (%.0fx)" % (before * 1e6, after * 1e6, before / after))
+
+# Representative student programs: (source, addresses holding the result)
+ENGINE_PROGRAMS = {
+    "multiply": ("""
+0 LOAD 102
+1 ADD 100
+2 STORE 102
+3 LOAD 101
+4 SUBTRACT 103
+5 STORE 101
+6 JUMPZERO 8
+7 JUMP 0
+100 7
+101 2000
+102 0
+103 1
+""", [102]),
+    "subroutine": ("""
+0 JUMPSUB 20
+1 LOAD 41
+2 SUBTRACT 42
+3 STORE 41
+4 JUMPZERO 6
+5 JUMP 0
+20 0
+21 LOAD 40
+22 ADD 43
+23 MULTIPLY 44
+24 DIVIDE 45
+25 STORE 40
+26 RETURN 20
+40 0
+41 1000
+42 1
+43 7
+44 3
+45 2
+""", [40, 41]),
+    "array sum (LOADID)": ("""
+0 LOADID 52
+1 ADD 50
+2 STORE 50
+3 LOAD 52
+4 ADD 51
+5 STORE 52
+6 SUBTRACT 53
+7 JUMPZERO 9
+8 JUMP 0
+50 0
+51 1
+52 200
+53 1200
+""" + "\n".join("%i %i" % (address, address % 97) for address in range(200, 1200)), [50]),
+    "array sum (self-modifying)": ("""
+0 LOAD 50
+1 ADD 200
+2 STORE 50
+3 LOAD 1
+4 ADD 51
+5 STORE 1
+6 LOAD 52
+7 SUBTRACT 51
+8 STORE 52
+9 JUMPZERO 11
+10 JUMP 0
+50 0
+51 1
+52 1000
+""" + "\n".join("%i %i" % (address, address % 89) for address in range(200, 1200)), [50, 1]),
+    "high operand": ("""
+0 LOAD 3000
+1 ADD 3000
+2 STORE 100
+3000 7
+""", [100]),
+}
+
+def benchEngines():
+    engines = [computer.MachineSim, computer.FastMachineSim, computer.JitMachineSim]
+    for name, (source, resultAddresses) in ENGINE_PROGRAMS.items():
+        program = computer.MachineProgram(source)
+        times = []
+        results = set()
+        for engine in engines:
+            sim = engine()
+            sim.loadProgram(program)
+            times.append(bestOf(lambda: sim.run(reload=True), 1))
+            results.add(tuple(sim.readMemory(address) for address in resultAddresses))
+        assert len(results) == 1, "engines disagree on %s: %r" % (name, results)
+        print("%-28s " % name + "  ".join("%s %7.2f ms (%4.1fx)" % (engine.__name__, seconds * 1000, times[0] / seconds)
+                                            for engine, seconds in zip(engines, times)))
+
+def benchProfiler():
+    program = computer.MachineProgram(ENGINE_PROGRAMS["multiply"][0])
+    for engine in [computer.MachineSim, computer.FastMachineSim, computer.JitMachineSim]:
+        sim = engine()
+        sim.loadProgram(program)
+        plain = bestOf(lambda: sim.run(reload=True), 1)
+        sim.setTrace(computer.MachineProfiler())
+        counted = bestOf(lambda: sim.run(reload=True), 1)
+        sim.setTrace(computer.MachineProfiler(timed=True))
+        timed = bestOf(lambda: sim.run(reload=True), 1)
+        sim.setTrace(None)
+        print("profiler %-16s counting %4.2fx, timed %4.2fx" % (engine.__name__, counted / plain, timed / plain))
+
+# Programs that never halt; the analysis must find the loop. (source, loop)
+ANALYSIS_PROGRAMS = {
+    "JUMPSUB 4095": ("0 JUMPSUB 4095", [0]),
+    "JUMP 4095": ("0 LOAD 5\n1 JUMP 4095\n4095 NOP", [-1, 0, 1]),
+}
+
+def benchAnalysis():
+    for name, (source, loop) in ANALYSIS_PROGRAMS.items():
+        program = computer.MachineProgram(source)
+        analysis = computer.analyzeProgram(program)
+        assert not analysis.mayHalt and analysis.infiniteLoops == [loop], "%s: %r" % (name, analysis.report())
+        sim = computer.FastMachineSim()
+        sim.loadProgram(program)
+        try:
+            sim.run(maxSteps=1000)
+        except computer.InfiniteLoop:
+            pass
+        else:
+            raise AssertionError("%s halted" % name)
+    program = computer.MachineProgram(generatedSource())
+    seconds = bestOf(lambda: computer.analyzeProgram(program), 1)
+    print("analysis: %.2f ms for a full %i word program" % (seconds * 1000, computer.MachineProgram.MAX_ADDRESS + 1))
+
+def benchNBitInt():
+    NBitInt = nbitint.NBitInt
+    value = NBitInt(16, -1234)
+    def add():
+        x = NBitInt(16, 1000)
+        x += value
+    def shift():
+        x = NBitInt(16, 1000)
+        x <<= 1
+    cases = [
+        ("construct", lambda: NBitInt(16, 1234)),
+        ("construct (negative)", lambda: NBitInt(16, -1234)),
+        ("+=", add),
+        ("<<=", shift),
+        ("splitToArray", lambda: value.splitToArray(4, 12)),
+        ("copy", value.copy),
+        ("int", lambda: int(value)),
+    ]
+    print("NBitInt: " + ", ".join("%s %.0f ns" % (name, bestOf(func, 100000) * 1e9) for name, func in cases))
+    words = nbitint.NBitArray.fromValues(16, range(4096))
+    other = words.copy()
+    other[100] = 0
+    snapshot = words.snapshot()
+    cases = [
+        ("add", lambda: words.add(3)),
+        ("shiftLeft", lambda: words.shiftLeft(1)),
+        ("toSigned", words.toSigned),
+        ("snapshot", words.snapshot),
+        ("restore", lambda: words.restore(snapshot)),
+        ("diff", lambda: words.diff(other)),
+    ]
+    print("NBitArray (4096 words): " + ", ".join("%s %.1f us" % (name, bestOf(func, 1000) * 1e6) for name, func in cases))
+
+# A = B, then A = A - 1 until A is zero. Addresses 3 and 4 jump to 5 (halt) and back to 1.
+MICRO_SOURCE = """
+0: 2 9 17 22
+1: 1 5 7 9 17 22
+2: 19 22
+3: 6 8 18
+4: 8 18
+"""
+
+def benchMicro():
+    program = microcode.MicroProgram(MICRO_SOURCE)
+    sim = microcode.MicroSim(program)
+    def run():
+        sim.setABCD(0, 300, 0, 0)
+        return sim.execute()
+    cycleCount = run()
+    seconds = bestOf(run, 5)
+    print("micro: %i cycles in %.2f ms, %.2f us per cycle" % (cycleCount, seconds * 1000, seconds / cycleCount * 1e6))
+    if microcode.numpy is None:
+        return
+    lanes = 1000
+    vector = microcode.VectorMicroSim(lanes, program)
+    def runVector():
+        vector.resetRegisters()
+        vector.setB([300 + lane % 8 for lane in range(lanes)])
+        vector.execute()
+    runVector()
+    laneCycles = int(vector.cycles.sum())
+    seconds = bestOf(runVector, 1, 3)
+    print("micro (VectorMicroSim, %i lanes): %i lane cycles in %.2f ms, %.3f us per lane cycle" % (
+        lanes, laneCycles, seconds * 1000, seconds / laneCycles * 1e6))
+
+BENCHMARKS = {
+    "nbitint": benchNBitInt,
+    "parse": benchParse,
+    "image": benchImage,
+    "restore": benchRestore,
+    "dispatch": benchDispatch,
+    "engines": benchEngines,
+    "profiler": benchProfiler,
+    "analysis": benchAnalysis,
+    "micro": benchMicro,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
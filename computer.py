@@ -1,215 +1,27 @@
-import operator
-import random
-
-class NBitInt:
-    def __init__(self, bits, num=0, unsigned=False):
-        self.value = num
-        self.bits = bits
-        self.bitmask = 2**bits-1
-        self.unsigned = unsigned
-
-        if num < 0:
-            self.value = abs(num)
-            self.value = NBitInt.__complement_impl(self.bits, self.value)
-
-    def __signBit(self):
-        if not self.unsigned:
-            return (self.value >> (self.bits-1)) & 1
-        return 0 # treat first bit as data bit
-
-    def isSigned(self):
-        return self.__signBit() != 0
-
-    def isZero(self):
-        return self.value == 0
-
-    def splitToArray(self, *args):
-        if sum(args) != self.bits:
-            raise ValueError("Invalid params: " + repr(args))
-        result = []
-        mask = self.bitmask
-
-        cumulBits = 0
-        for bits in args:
-            num = (self.value << cumulBits) & self.bitmask #discard high order bits
-            num = num >> (self.bits - bits)
-            cumulBits += bits
-            result.append(num)
-
-        return result
-
-    def copy(self):
-        return NBitInt(self.bits,int(self),self.unsigned)
-
-#OPERATORS
-#ARITHMETIC
-    @staticmethod
-    def __add_impl(x, y, bitmask):
-        return (x+y) & bitmask
-
-    def __add__(self, other):
-        other = int(other)
-        return NBitInt(self.bits,
-                       NBitInt.add_impl(self.value, other.value, self.bitmask),
-                       unsigned=self.unsigned)
-
-    def __iadd__(self, other):
-        other = int(other)
-        self.value = NBitInt.__add_impl(self.value, other, self.bitmask)
-        return self
-
-    @staticmethod
-    def __subtract_impl(lhs, rhs):
-        rhs = -rhs
-        result = lhs + rhs
-        return result
-
-    def __sub__(self, other):
-        return NBitInt.subtract_impl(self, other)
-
-    def __isub__(self, other):
-        other = -other
-        self += other
-        return self
-
-    @staticmethod
-    def __multiply_impl(bitmask, x, y):
-        return (x*y) & bitmask
-
-    def __mul__(self, other):
-        other = int(other)
-        return NBitInt(self.bits,
-                       NBitInt.multiply_impl(self.bitmask, self.value, other),
-                       unsigned=self.unsigned)
-
-    def __imul__(self, other):
-        other = int(other)
-        self.value = NBitInt.__multiply_impl(self.bitmask, self.value, other)
-        return self
-
-    @staticmethod
-    def __complement_impl(bits, y):
-        return 2**bits - y
-
-
-    def __neg__(self):
-        value = NBitInt.__complement_impl(self.bits, self.value)
-        return NBitInt(self.bits, value, unsigned=self.unsigned)
-
-    @staticmethod
-    def __divide_impl(x, y):
-        # print("%i,%i" % (x,y))
-        # print("%i", x.isSigned())
-        x,y = map(int, map(str, (x,y)))
-        result = x//y
-        return result
-
-    def __floordiv__(self, other):
-        value = NBitInt.divide_impl(self.value, other)
-        return NBitInt(self.bits, value, unsigned=self.unsigned)
-
-    def __ifloordiv__(self, other):
-
-        value = NBitInt.__divide_impl(self, other)
-
-        if value < 0:
-            value = NBitInt.__complement_impl(self.bits, abs(value))
-        self.value = value
-        return self
-
-#END ARITHMETIC OPERATORS
-
-#SHIFT OPERATORS
-
-    def __lshift_impl(self, num):
-        return (self.value << num) & self.bitmask
-
-    def __lshift__(self, num):
-        return NBitInt(self.bits, self.__lshift_impl(num), unsigned=self.unsigned)
-
-    def __ilshift__(self, num):
-        self.value = self.__lshift_impl(num)
-        return self
-
-    def __rshift__(self, num):
-        return NBitInt(self.bits, self.value >> num, unsigned=self.unsigned)
-
-    def __irshift__(self, num):
-        self.value >>= num
-        return self
-
-    #If one of the operands is unsigned, the result will also be. The result has as many bits as the largest operand
-    @staticmethod
-    def binop_impl(num1, num2, oper):
-        isNbit = [isinstance(x, NBitInt) for x in [num1, num2]]
-        bits = 16
-        unsigned = True
-        val1 = val2 = 0
-        if all(isNbit):
-            bits = max(num1.bits, num2.bits)
-            unsigned = num1.unsigned | num2.unsigned
-            val1, val2 = num1.value, num2.value
-        elif any(isNbit):
-            if isNbit[1]:
-                num1,num2 = num2,num1 #swap
-            val1, val2 = num1.value, num2
-            bits = num1.bits
-            unsigned = num1.unsigned
-        val = oper(val1, val2)
-        return NBitInt(bits, num=val, unsigned=unsigned)
-
-    def __and__(self, other):
-        return NBitInt.binop_impl(self, other, operator.__and__)
-
-    def __iand__(self, other):
-        self.value = NBitInt.binop_impl(self, other, operator.__and__).value
-        return self
-
-    def __or__(self, other):
-        return NBitInt.binop_impl(self, other, operator.__or__)
-
-    def __ior__(self, other):
-        self.value = NBitInt.binop_impl(self, other, operator.__or__).value
-        return self
-
-    def __xor__(self, other):
-        return NBitInt.binop_impl(self, other, operator.__xor__)
-
-    def __ixor__(self, other):
-        self.value = NBitInt.binop_impl(self, other, operator.__ixor__).value
-        return self
-
-#Unary operators
-    def __invert__(self):
-        return NBitInt(self.bits, num=(self.bitmask - self.value), unsigned=self.unsigned)
-
-    def __pos__(self):
-        return self.copy()
-#End unary operators
-
-#Built-in functions
-    def __abs__(self):
-        return NBitInt(self.bits, num=abs(self.value))
-
-    def __int__(self):
-        if self.isSigned():
-            return -NBitInt.__complement_impl(self.bits, self.value)
-        return self.value
-
-    def __oct__(self):
-        return oct(self.value)
-
-    def __hex__(self):
-        return hex(self.value)
-
-    #Not actually built-in, but it fits here
-    def bin(self):
-        return bin(self.value)
-
-    def __str__(self):
-        return str(int(self))#encoding: utf-8
+#encoding: utf-8
 
 import re
+import sys
+import random
+import mmap
+import time
+import types
+import struct
+import hashlib
+import itertools
+import multiprocessing
+from array import array
+from collections import OrderedDict, defaultdict, deque, namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # VectorMachineSim is unavailable without NumPy
+
+try:
+    NBitInt # already defined when nbitint.py is bundled in front of this file
+except NameError:
+    from nbitint import NBitInt, NBitArray, groupLanes
 
 class MachineException(Exception):
     def __init__(self, value):
@@ -217,24 +29,251 @@ class MachineException(Exception):
     def __str__(self):
         return repr(self.value)
 
+class InfiniteLoop(MachineException):
+    def __init__(self, value, PC, ACC, steps):
+        MachineException.__init__(self, value)
+        self.PC = PC
+        self.ACC = ACC
+        self.steps = steps
+
+# Register and memory image taken by snapshot(); the field contents are engine specific
+MachineSnapshot = namedtuple("MachineSnapshot", "PC ACC IR memory decoded dirty")
+
+class SparseMemory:
+    # Main memory that stores only written cells. Reads fall back to a shared, read-only base image
+    # (the loaded program) and then to zero, so resetting or copying costs O(written cells).
+    # Cells are never modified in place, so the base image and the zero cell can be shared.
+    def __init__(self, size, bits, base=None):
+        self.size = size
+        self.zero = NBitInt.interned(bits, 0)
+        self.base = {} if base is None else base
+        self.cells = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, address):
+        if address < 0:
+            address += self.size
+        value = self.cells.get(address)
+        if value is None:
+            value = self.base.get(address)
+            if value is None:
+                if not 0 <= address < self.size:
+                    raise IndexError("memory address out of range")
+                return self.zero
+        return value
+
+    def __setitem__(self, address, value):
+        if address < 0:
+            address += self.size
+        if not 0 <= address < self.size:
+            raise IndexError("memory address out of range")
+        self.cells[address] = value
+
+    def loadImage(self, image):
+        if self.base and self.base is not image:
+            for address, value in self.base.items():
+                self.cells.setdefault(address, value)
+        for address in [address for address in self.cells if address in image]:
+            del self.cells[address]
+        self.base = image
+
+    def reset(self):
+        self.cells.clear()
+        self.base = {}
+
+    def copy(self):
+        memory = SparseMemory(self.size, self.zero.bits, self.base)
+        memory.cells = dict(self.cells)
+        return memory
+
+class TraceSink:
+    # Receives one record() call per executed instruction while attached with MachineSim.setTrace().
+    # value is the signed word at the operand address before execution (None if the operand is
+    # not a valid address), write is (address, value) for STORE and JUMPSUB.
+    # Sinks with timed set also get recordTime() with the host time spent in each handler.
+    # Sinks with counting set get no record() calls; the engines count into them directly, see
+    # MachineProfiler.count.
+    timed = False
+    counting = False
+
+    def record(self, PC, opcode, operand, value, accBefore, accAfter, write):
+        pass
+
+    def recordTime(self, opcode, seconds):
+        pass
+
+class PrintTraceSink(TraceSink):
+    # The DEBUG program instruction output: one line per instruction
+    VALUE_OPERATIONS = ("LOAD", "ADD", "SUBTRACT", "MULTIPLY", "DIVIDE", "RETURN", "LOADID")
+    ACC_SUFFIX = {"ADD": " to ACC=", "SUBTRACT": " from ACC=", "MULTIPLY": " with ACC=", "DIVIDE": " with ACC="}
+
+    def record(self, PC, opcode, operand, value, accBefore, accAfter, write):
+        operation = MachineSim.OPERATION_NAMES.get(opcode, "NOP")
+        s = str(PC) + " " + operation + " "
+        if value is not None and operation in self.VALUE_OPERATIONS:
+            s += "(" + str(operand) + ")=" + str(value) + "=" + bin(value & 0xFFFF)
+        else:
+            s += str(operand) + " ACC=" + str(accBefore)
+        if operation in self.ACC_SUFFIX:
+            s += self.ACC_SUFFIX[operation] + str(accBefore)
+        print(s)
+
+TraceEvent = namedtuple("TraceEvent", "PC opcode operand value accBefore accAfter write")
+
+class TraceRecorder(TraceSink):
+    # Keeps the last size instructions in a ring buffer
+    def __init__(self, size=1000):
+        self.buffer = deque(maxlen=size)
+
+    def record(self, *event):
+        self.buffer.append(event)
+
+    def events(self):
+        return [TraceEvent(*event) for event in self.buffer]
+
+    def clear(self):
+        self.buffer.clear()
+
+class MachineProfiler(TraceSink):
+    # Execution counts per address and opcode plus memory reads and writes per address.
+    # Attach with MachineSim.setTrace(); counts accumulate over runs until reset().
+    # Without timed the engines only count executions per address and note the decoded
+    # (handler, operand, opcode) entry each address runs; flush() turns these into the opcode, read
+    # and write counts.
+    READ_OPERATIONS = ("LOAD", "ADD", "SUBTRACT", "MULTIPLY", "DIVIDE", "RETURN", "LOADID")
+
+    def __init__(self, timed=False, size=4096):
+        self.timed = timed
+        self.counting = not timed
+        self.size = size
+        self.readOpcodes = frozenset(MachineSim.OPERATIONS[name] for name in self.READ_OPERATIONS)
+        self.indirectOpcode = MachineSim.OPERATIONS["LOADID"]
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.executions = [0] * self.size
+        self.opcodes = [0] * 16
+        self.reads = [0] * self.size
+        self.writes = [0] * self.size
+        self.handlerTime = [0.0] * 16
+        self.entries = defaultdict(int) # (handler, operand, opcode) -> executions not yet flushed
+        self.tracked = [None] * self.size # the entry each address was last executed as
+        self.trackedFrom = [0] * self.size # executions[address] when tracked was set
+        self.trackedAddresses = set()
+
+    def track(self, PC, entry):
+        # PC now runs a different decoded entry, the executions so far belong to the old one
+        address = PC % self.size
+        old = self.tracked[address]
+        if old is not None:
+            self.entries[old] += self.executions[address] - self.trackedFrom[address]
+        self.tracked[address] = entry
+        self.trackedFrom[address] = self.executions[address]
+        self.trackedAddresses.add(address)
+
+    def count(self, PC, entry, target=None, times=1):
+        # Executed instructions: entry is the decoded (handler, operand, opcode) and target the address
+        # LOADID read. FastMachineSim.run inlines this.
+        if self.tracked[PC] is not entry:
+            self.track(PC, entry)
+        self.executions[PC] += times
+        if target is not None and -self.size <= target < self.size:
+            self.reads[target] += 1
+
+    def flush(self):
+        for address in self.trackedAddresses:
+            self.entries[self.tracked[address]] += self.executions[address] - self.trackedFrom[address]
+            self.trackedFrom[address] = self.executions[address]
+        writeOpcodes = MachineSim.WRITE_OPCODES
+        for (handler, operand, opcode), count in self.entries.items():
+            self.steps += count
+            self.opcodes[opcode] += count
+            if opcode in self.readOpcodes:
+                self.reads[operand] += count
+            if opcode in writeOpcodes:
+                self.writes[operand] += count
+        self.entries.clear()
+
+    def record(self, PC, opcode, operand, value, accBefore, accAfter, write):
+        self.steps += 1
+        self.executions[PC] += 1
+        self.opcodes[opcode] += 1
+        if value is not None and opcode in self.readOpcodes:
+            self.reads[operand] += 1
+            if opcode == self.indirectOpcode and -self.size <= value < self.size:
+                self.reads[value] += 1
+        if write is not None:
+            self.writes[write[0]] += 1
+
+    def recordTime(self, opcode, seconds):
+        self.handlerTime[opcode] += seconds
+
+    @staticmethod
+    def __nonZero(counts):
+        return {address: count for address, count in enumerate(counts) if count}
+
+    def __byOperation(self, values):
+        return {MachineSim.OPERATION_NAMES.get(opcode, str(opcode)): value for opcode, value in enumerate(values) if value}
+
+    def hotspots(self, count=10):
+        self.flush()
+        return sorted(self.__nonZero(self.executions).items(), key=lambda item: -item[1])[:count]
+
+    def report(self):
+        self.flush()
+        report = {
+            "steps": self.steps,
+            "executions": self.__nonZero(self.executions),
+            "operations": self.__byOperation(self.opcodes),
+            "reads": self.__nonZero(self.reads),
+            "writes": self.__nonZero(self.writes),
+            "hotspots": self.hotspots(),
+        }
+        if self.timed:
+            report["handlerTime"] = self.__byOperation(self.handlerTime)
+        return report
+
+_printTrace = PrintTraceSink()
+
 class MachineSim:
+    _dispatchTables = {}
     debug = False
+    trace = None # TraceSink receiving every executed instruction, see setTrace
+    maxSteps = None # instructions per run, None = unlimited
+    timeLimit = None # seconds per run, None = unlimited
+    raiseErrors = False # run re-raises MachineException instead of printing it, set for batch runs
+    DEADLINE_CHECK_INTERVAL = 1024 # steps between clock reads
     DATA_BITS = 16
     OP_BITS = 4
     VALUE_BITS = 12
     MIN_ADDRESS = 0
     MAX_ADDRESS = 4095
 
-    def __init__(self, extended=True):
+    def __init__(self, extended=True, sparse=False):
+        self.sparse = sparse
         self.resetRegisters()
         self.resetRam()
         self.extensionsAllowed = extended
 
+    @classmethod
+    def dispatchTable(cls, extensionsAllowed):
+        # handler for each of the 16 opcodes, built once per class and extension setting
+        key = (cls, extensionsAllowed)
+        table = MachineSim._dispatchTables.get(key)
+        if table is None:
+            table = [cls.opr_NOP] * (2 ** cls.OP_BITS)
+            for operation, (bits, func) in cls.OPERATIONS_DEF.items():
+                table[bits] = getattr(cls, "opr_" + operation)
+            for operation, (bits, func) in cls.OPERATIONS_EXTENDED.items():
+                table[bits] = getattr(cls, "opr_" + operation) if extensionsAllowed else cls.opr_DISABLED
+            MachineSim._dispatchTables[key] = table
+        return table
+
     def _getOperationFunc(self, oper):
-        try:
-            return [func for operation, (bits, func) in MachineSim.OPERATIONS_DEF.items()|MachineSim.OPERATIONS_EXTENDED.items() if int(bits)==int(oper)][0]
-        except:
-            return self.opr_NOP
+        return self.dispatchTable(self.extensionsAllowed)[oper]
     
     def resetRegisters(self):
         self.ACC = NBitInt(self.DATA_BITS, 0)
@@ -242,7 +281,18 @@ class MachineSim:
         self.IR = NBitInt(self.PC)
 
     def resetRam(self):
-        self.MM = [NBitInt(self.DATA_BITS,0) for x in range(self.MIN_ADDRESS, self.MAX_ADDRESS+1)]
+        if not self.sparse:
+            self.MM = [NBitInt.interned(self.DATA_BITS, 0)] * (self.MAX_ADDRESS - self.MIN_ADDRESS + 1)
+        elif isinstance(getattr(self, "MM", None), SparseMemory):
+            self.MM.reset()
+        else:
+            self.MM = SparseMemory(self.MAX_ADDRESS + 1, self.DATA_BITS)
+        self.resetDecoded()
+        self.markClean()
+
+    def resetDecoded(self):
+        # decoded[address] = (handler, operand, opcode); indexed like MM so negative addresses alias the same way
+        self.decoded = [None] * (self.MAX_ADDRESS + 1)
 
     def __updateIR(self):
         self.IR = self.MM[self.PC]
@@ -251,144 +301,224 @@ class MachineSim:
         self.currentProgram = machineProgram
         self.PC = machineProgram.getStartAddress()
         self.__copyProgram()
+        self.markClean()
         self.__updateIR()
 
     def setMemory(self, address, value):
-        self.MM[address] = NBitInt(self.DATA_BITS, value)
+        self._writeMemory(address, NBitInt(self.DATA_BITS, value))
+
+    def _writeMemory(self, address, value):
+        if address not in self.dirty:
+            self.dirty[address] = self.MM[address]
+        self.MM[address] = value
+        self.decoded[address] = None
+
+    def markClean(self):
+        # Memory as it is now becomes the baseline of memoryDelta(). Done by loadProgram; call again
+        # after setting the inputs to leave them out of the delta.
+        self.dirty = {} # address written -> value before its first write
+
+    def writtenAddresses(self):
+        size = self.MAX_ADDRESS + 1
+        return sorted({address % size for address in self.dirty})
+
+    def memoryDelta(self):
+        # {address: value} of the written cells whose value now differs from the baseline,
+        # in O(written cells). Negative addresses are reported as the cells they alias.
+        size = self.MAX_ADDRESS + 1
+        before = {}
+        for address, value in self.dirty.items():
+            before.setdefault(address % size, value)
+        delta = {}
+        for address, value in before.items():
+            current = self.readMemory(address)
+            if current != int(value):
+                delta[address] = current
+        return delta
 
     def __copyProgram(self):
-        for line,ins in self.currentProgram.getProgramBinary().items():
-            self.MM[line] = ins.copy()
+        if self.sparse:
+            self.MM.loadImage(self.currentProgram.getProgramBinary())
+        else:
+            for line,ins in self.currentProgram.getProgramBinary().items():
+                self.MM[line] = ins.copy()
+        self.resetDecoded()
+
+    def _decode(self, address):
+        rawOp, rawValue = self.MM[address].splitToArray(self.OP_BITS, self.VALUE_BITS)
+        entry = (self._getOperationFunc(rawOp), int(NBitInt(self.VALUE_BITS, rawValue)), rawOp)
+        self.decoded[address] = entry
+        return entry
 
     def executeNext(self):
-        rawOp, rawValue = self.IR.splitToArray(self.OP_BITS, self.VALUE_BITS)
-        op = self._getOperationFunc(rawOp)
-        value = NBitInt(self.VALUE_BITS, rawValue)
+        pc = self.PC
+        entry = self.decoded[pc] or self._decode(pc)
+        op, address, opcode = entry
         valueAtAddress=None
-        if self.MIN_ADDRESS <= int(value) <= self.MAX_ADDRESS:
-            valueAtAddress = self.MM[int(value)].copy()
-        op(self, value, valueAtAddress)
+        # operands 2048-4095 decode as negative and alias the same cells, as in the other engines
+        if -self.MAX_ADDRESS - 1 <= address <= self.MAX_ADDRESS:
+            valueAtAddress = self.MM[address].copy()
+        trace = self.activeTrace()
+        if trace is None:
+            op(self, address, valueAtAddress)
+        elif trace.counting:
+            op(self, address, valueAtAddress)
+            trace.count(pc, entry, int(valueAtAddress) if op is MachineSim.opr_LOADID else None)
+        else:
+            self._traceStep(trace, op, address, valueAtAddress)
         self.__updateIR()
 
+    def setTrace(self, trace):
+        self.trace = trace
+
+    def activeTrace(self):
+        if self.trace is None and self.debug:
+            return _printTrace
+        return self.trace
+
+    def _wordAt(self, address):
+        return self.MM[address].value
+
+    def _traceStep(self, trace, op, address, *args):
+        pc = self.PC
+        opcode = (self._wordAt(pc) >> self.VALUE_BITS) & 0xF
+        value = None
+        if -self.MAX_ADDRESS - 1 <= address <= self.MAX_ADDRESS:
+            value = self.readMemory(address)
+        accBefore = self.readACC()
+        if trace.timed:
+            start = time.perf_counter()
+            op(self, address, *args)
+            trace.recordTime(opcode, time.perf_counter() - start)
+        else:
+            op(self, address, *args)
+        write = None
+        if opcode in self.WRITE_OPCODES:
+            write = (address, self.readMemory(address))
+        trace.record(pc, opcode, address, value, accBefore, self.readACC(), write)
+
     def incr_PC(self):
         self.PC = self.PC+1
 
     def opr_NOP(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("NOP", address))
         self.incr_PC()
 
     def opr_LOAD(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("LOAD", address, valueAtAddress))
         self.ACC = valueAtAddress
         self.incr_PC()
 
     def opr_STORE(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("STORE", address))
-        self.MM[int(address)] = self.ACC.copy()
+        self._writeMemory(address, self.ACC.copy())
         self.incr_PC()
 
     def opr_ADD(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("ADD", address, valueAtAddress) + " to ACC=" + str(self.ACC))
         self.ACC += valueAtAddress
         self.incr_PC()
 
     def opr_SUBTRACT(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("SUBTRACT", address, valueAtAddress) + " from ACC=" + str(self.ACC))
         self.ACC -=valueAtAddress
         self.incr_PC()
 
     def opr_MULTIPLY(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("MULTIPLY", address, valueAtAddress) + " with ACC=" + str(self.ACC))
         self.ACC *= valueAtAddress
         self.incr_PC()
 
     def opr_DIVIDE(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("DIVIDE", address, valueAtAddress) + " with ACC=" + str(self.ACC))
         self.ACC //= valueAtAddress
         self.incr_PC()
 
     def opr_JUMP(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("JUMP", address))
         self.PC = int(address)
 
     def opr_JUMPZERO(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("JUMPZERO", address))
         if self.ACC.isZero():
             self.PC = int(address)
         else:
             self.incr_PC()
 
     def opr_JUMPNEG(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("JUMPNEG", address))
         if self.ACC.isSigned():
             self.PC = int(address)
         else:
             self.incr_PC()
 
     def opr_JUMPSUB(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("JUMPSUB", address))
-        self.MM[int(address)] = NBitInt(self.DATA_BITS, self.PC + 1)
-        self.PC = int(address)+1
+        self._writeMemory(address, NBitInt(self.DATA_BITS, self.PC + 1))
+        self.PC = address+1
 
     def opr_RETURN(self, address, valueAtAddress):
-        if self.debug:
-            print (self.oprDebugString("RETURN", address, valueAtAddress))
         self.PC = int(valueAtAddress)
 
+    def opr_DISABLED(self, *args):
+        raise MachineException(f"Laajennetut komennot {','.join(MachineSim.OPERATIONS_EXTENDED.keys())} eivät ole käytössä")
+
     def opr_LOADI(self, value, notUsed=None):
-        if not self.extensionsAllowed:
-            raise MachineException(f"Laajennetut komennot {','.join(MachineSim.OPERATIONS_EXTENDED.keys())} eivät ole käytössä")
-        if self.debug:
-            print (self.oprDebugString("LOADI", value))
-        self.ACC = value
+        self.ACC = NBitInt(self.DATA_BITS, value)
         self.incr_PC()
 
     def opr_LOADID(self, address, valueAtAddress):
-        if not self.extensionsAllowed:
-            raise MachineException(f"Laajennetut komennot {','.join(MachineSim.OPERATIONS_EXTENDED.keys())} eivät ole käytössä")
-        if self.debug:
-            print (self.oprDebugString("LOADID", address, valueAtAddress))
-        self.ACC = self.MM[int(valueAtAddress)]
+        self.ACC = self.MM[int(valueAtAddress)].copy()
         self.incr_PC()
 
-    def oprDebugString(self, operation, address, valueAtAddress=None):
-        s = str(self.PC) + " " + operation + " "
-        if valueAtAddress != None:
-            s += "("
-        s += str(address)
+    def readACC(self):
+        return int(self.ACC)
 
-        if valueAtAddress != None:
-            s += ")"
-            s += "=" + str(valueAtAddress)
-            s += "=" + valueAtAddress.bin()
-        else:
-            s += " ACC=" + str(self.ACC)
-        return s
+    def limitExceeded(self, reason, steps):
+        return InfiniteLoop("Loputon silmukka: %s (PC=%i, ACC=%i, %i käskyä)" % (reason, self.PC, self.readACC(), steps),
+                            self.PC, self.readACC(), steps)
+
+    def _deadline(self, timeLimit):
+        timeLimit = self.timeLimit if timeLimit is None else timeLimit
+        if timeLimit is None:
+            return None
+        return time.monotonic() + timeLimit
 
-    def run(self, reload=False):
+    def _runLoop(self, step, running, reload, maxSteps, timeLimit):
+        # The run loop of every engine. step(limit) runs at most limit instructions (None = no
+        # limit) from PC, stopping at a zero word, and returns how many it ran; running() is false
+        # at a zero word. Between the calls the loop checks maxSteps and, every
+        # DEADLINE_CHECK_INTERVAL instructions, the clock.
         if reload:
             self.resetRam()
             self.resetRegisters()
             self.loadProgram(self.currentProgram)
-        lastIns = None
-        while not self.IR.isZero():
-            lastIns = self.PC
-            try:
-                self.executeNext()
-            except MachineException as e:
-                print("Virhe tietokoneen suorituksen aikana:",e)
-                break
+        maxSteps = self.maxSteps if maxSteps is None else maxSteps
+        deadline = self._deadline(timeLimit)
+        checkInterval = self.DEADLINE_CHECK_INTERVAL
+        steps = 0
+        try:
+            while running():
+                if steps == maxSteps:
+                    raise self.limitExceeded("käskyraja ylittyi", steps)
+                if deadline is not None and time.monotonic() > deadline:
+                    raise self.limitExceeded("aikaraja ylittyi", steps)
+                limit = None if maxSteps is None else maxSteps - steps
+                if deadline is not None and (limit is None or limit > checkInterval):
+                    limit = checkInterval
+                try:
+                    steps += step(limit)
+                except MachineException as e:
+                    if self.raiseErrors:
+                        raise
+                    print("Virhe tietokoneen suorituksen aikana:",e)
+                    break
+        finally:
+            self._runFinished()
+
+    def _runFinished(self):
+        trace = self.activeTrace()
+        if trace is not None and trace.counting:
+            trace.flush()
+
+    def _steps(self, limit):
+        steps = 0
+        while steps != limit and not self.IR.isZero():
+            self.executeNext()
+            steps += 1
+        return steps
+
+    def run(self, reload=False, maxSteps=None, timeLimit=None):
+        self._runLoop(self._steps, lambda: not self.IR.isZero(), reload, maxSteps, timeLimit)
 
     FI_OPER =  {
         "LATAA": "LOAD",
@@ -423,9 +553,12 @@ class MachineSim:
     }
 
     OPERATIONS = {keyword : value for keyword, (value,func) in OPERATIONS_DEF.items()|OPERATIONS_EXTENDED.items()}
+    OPERATION_NAMES = {value : keyword for keyword, value in OPERATIONS.items()}
+    WRITE_OPCODES = (OPERATIONS_DEF["STORE"][0], OPERATIONS_DEF["JUMPSUB"][0])
     
     def disableExtensions(self):
-        del self.OPERATIONS_FUNC[self.OPERATIONS_DEF["LOADID"][0]]
+        self.extensionsAllowed = False
+        self.resetDecoded()
 
     def printState(self, memory=[],ACC=False, IR=False, PC=False):
         s = ""
@@ -443,6 +576,597 @@ class MachineSim:
     def readMemory(self, address):
         return int(self.MM[address])
 
+    def snapshot(self):
+        # Memory cells are never modified in place, so a shallow copy of MM is enough
+        return MachineSnapshot(self.PC, self.ACC.copy(), self.IR, self.MM.copy(), list(self.decoded), dict(self.dirty))
+
+    def restore(self, snapshot):
+        self.PC = snapshot.PC
+        self.ACC = snapshot.ACC.copy()
+        self.IR = snapshot.IR
+        self.MM = snapshot.memory.copy()
+        self.decoded = list(snapshot.decoded)
+        self.dirty = dict(snapshot.dirty)
+
+class FastMachineSim(MachineSim):
+    # Same machine as MachineSim, but ACC and MM hold raw 16-bit words as plain ints.
+    # MMUnsigned marks cells holding instruction words, which MachineSim keeps as unsigned NBitInts.
+    # Memory is always a flat array, the sparse option only applies to MachineSim.
+    DATA_MASK = 0xFFFF
+    SIGN_BIT = 0x8000
+
+    def resetRegisters(self):
+        self.ACC = 0
+        self.accUnsigned = 0
+        self.PC = 0
+        self.IR = 0
+
+    def resetRam(self):
+        self.MM = NBitArray(self.DATA_BITS, self.MAX_ADDRESS + 1)
+        self.MMUnsigned = bytearray(self.MAX_ADDRESS + 1)
+        self.resetDecoded()
+        self.markClean()
+
+    @staticmethod
+    def toSigned(value, unsigned=0):
+        if unsigned or not value & FastMachineSim.SIGN_BIT:
+            return value
+        return value - (FastMachineSim.DATA_MASK + 1)
+
+    def loadProgram(self, machineProgram):
+        self.currentProgram = machineProgram
+        self.PC = machineProgram.getStartAddress()
+        if isinstance(machineProgram, ProgramImage):
+            for line in machineProgram.addresses():
+                self.MM[line] = machineProgram.words[line]
+                self.MMUnsigned[line] = machineProgram.instruction[line]
+        else:
+            for line,ins in machineProgram.getProgramBinary().items():
+                self.MM[line] = ins.value & self.DATA_MASK
+                self.MMUnsigned[line] = ins.unsigned
+        self.resetDecoded()
+        self.markClean()
+        self.IR = self.MM[self.PC]
+
+    def setMemory(self, address, value):
+        self._writeMemory(address, value & self.DATA_MASK)
+
+    def _writeMemory(self, address, value, unsigned=0):
+        if address not in self.dirty:
+            self.dirty[address] = self.readMemory(address)
+        self.MM[address] = value
+        self.MMUnsigned[address] = unsigned
+        self.decoded[address] = None
+
+    def readMemory(self, address):
+        return self.toSigned(self.MM[address], self.MMUnsigned[address])
+
+    def snapshot(self):
+        return MachineSnapshot(self.PC, (self.ACC, self.accUnsigned), self.IR,
+                               (self.MM.snapshot(), bytes(self.MMUnsigned)), list(self.decoded), dict(self.dirty))
+
+    def restore(self, snapshot):
+        words, unsigned = snapshot.memory
+        self.PC = snapshot.PC
+        self.ACC, self.accUnsigned = snapshot.ACC
+        self.IR = snapshot.IR
+        self.MM.restore(words)
+        self.MMUnsigned = bytearray(unsigned)
+        self.decoded = list(snapshot.decoded)
+        self.dirty = dict(snapshot.dirty)
+
+    def _decode(self, address):
+        word = self.MM[address]
+        rawValue = word & 0xFFF
+        if rawValue & 0x800:
+            rawValue -= 0x1000 # operand is a signed 12-bit value, as in MachineSim
+        opcode = word >> self.VALUE_BITS
+        entry = (self._getOperationFunc(opcode), rawValue, opcode)
+        self.decoded[address] = entry
+        return entry
+
+    def executeNext(self):
+        pc = self.PC
+        entry = self.decoded[pc] or self._decode(pc)
+        op, address, opcode = entry
+        trace = self.activeTrace()
+        if trace is None:
+            op(self, address)
+        elif trace.counting:
+            op(self, address)
+            trace.count(pc, entry, self.readMemory(address) if op is FastMachineSim.opr_LOADID else None)
+        else:
+            self._traceStep(trace, op, address)
+        self.IR = self.MM[self.PC]
+
+    def _wordAt(self, address):
+        return self.MM[address]
+
+    def readACC(self):
+        return self.toSigned(self.ACC, self.accUnsigned)
+
+    def _runFinished(self):
+        self.IR = self.MM[self.PC]
+        MachineSim._runFinished(self)
+
+    def _steps(self, limit):
+        MM = self.MM
+        decoded = self.decoded
+        trace = self.activeTrace()
+        profiler = None
+        if trace is not None and trace.counting:
+            profiler, trace = trace, None
+            executions, tracked, reads, size = profiler.executions, profiler.tracked, profiler.reads, profiler.size
+            indirect = FastMachineSim.opr_LOADID
+        steps = 0
+        while steps != limit and MM[self.PC]:
+            pc = self.PC
+            entry = decoded[pc] or self._decode(pc)
+            op, address, opcode = entry
+            if trace is None:
+                op(self, address)
+            else:
+                self._traceStep(trace, op, address)
+            if profiler is not None:
+                # MachineProfiler.count inlined
+                if tracked[pc] is not entry:
+                    profiler.track(pc, entry)
+                executions[pc] += 1
+                if op is indirect:
+                    target = self.readMemory(address)
+                    if -size <= target < size:
+                        reads[target] += 1
+            steps += 1
+        return steps
+
+    def run(self, reload=False, maxSteps=None, timeLimit=None):
+        self._runLoop(self._steps, lambda: self.MM[self.PC], reload, maxSteps, timeLimit)
+
+    def opr_NOP(self, address):
+        self.PC += 1
+
+    def opr_LOAD(self, address):
+        self.ACC = self.MM[address]
+        self.accUnsigned = self.MMUnsigned[address]
+        self.PC += 1
+
+    def opr_STORE(self, address):
+        self._writeMemory(address, self.ACC, self.accUnsigned)
+        self.PC += 1
+
+    def opr_ADD(self, address):
+        self.ACC = (self.ACC + self.MM[address]) & self.DATA_MASK
+        self.PC += 1
+
+    def opr_SUBTRACT(self, address):
+        self.ACC = (self.ACC - self.MM[address]) & self.DATA_MASK
+        self.PC += 1
+
+    def opr_MULTIPLY(self, address):
+        self.ACC = (self.ACC * self.MM[address]) & self.DATA_MASK
+        self.PC += 1
+
+    def opr_DIVIDE(self, address):
+        self.ACC = (self.toSigned(self.ACC, self.accUnsigned) // self.readMemory(address)) & self.DATA_MASK
+        self.PC += 1
+
+    def opr_JUMP(self, address):
+        self.PC = address
+
+    def opr_JUMPZERO(self, address):
+        if self.ACC == 0:
+            self.PC = address
+        else:
+            self.PC += 1
+
+    def opr_JUMPNEG(self, address):
+        if not self.accUnsigned and self.ACC & self.SIGN_BIT:
+            self.PC = address
+        else:
+            self.PC += 1
+
+    def opr_JUMPSUB(self, address):
+        self._writeMemory(address, (self.PC + 1) & self.DATA_MASK)
+        self.PC = address+1
+
+    def opr_RETURN(self, address):
+        self.PC = self.readMemory(address)
+
+    def opr_LOADI(self, value):
+        self.ACC = value & self.DATA_MASK
+        self.accUnsigned = 0
+        self.PC += 1
+
+    def opr_LOADID(self, address):
+        target = self.readMemory(address)
+        self.ACC = self.MM[target]
+        self.accUnsigned = self.MMUnsigned[target]
+        self.PC += 1
+
+    def printState(self, memory=[],ACC=False, IR=False, PC=False):
+        s = ""
+        if ACC:
+            s += "[ACC:"+ str(self.readACC())+ "]"
+        if IR:
+            s += "[IR:"+ str(bin(self.IR))+ "]"
+        if PC:
+            s += "<PC:"+ str(self.PC)+ ">"
+        if len(memory) > 0:
+            for address in memory:
+                s += "[M" + str(address) + ":" + str(self.readMemory(address)) + "]"
+        return s
+
+class JitMachineSim(FastMachineSim):
+    # FastMachineSim that compiles straight-line runs of instructions (basic blocks) into Python
+    # functions over plain-int registers. A block ends at a jump, JUMPSUB or RETURN, at a zero word,
+    # or before an instruction that must be interpreted. When a STORE hits a compiled address all
+    # blocks are dropped and that address is interpreted from then on. Traced runs are interpreted,
+    # except with a counting MachineProfiler: then each block counts how many of its instructions
+    # ran, and LOADID, whose read depends on memory, is left to the interpreter.
+    MAX_BLOCK_LENGTH = 64
+    _codeCache = {} # generated source -> function, shared by all instances
+    CODE_CACHE_SIZE = 4096
+    blockProfiler = None # the counting profiler the current blocks were compiled for
+
+    def resetDecoded(self):
+        FastMachineSim.resetDecoded(self)
+        # start address -> (function, length, counts, entries), False if it can't be compiled.
+        # counts[n] is how many times the block ran its first n instructions, entries the
+        # (address, decoded entry) of each instruction.
+        self.blocks = {}
+        self.codeMap = bytearray(self.MAX_ADDRESS + 1)
+        self.interpretOnly = bytearray(self.MAX_ADDRESS + 1)
+
+    def restore(self, snapshot):
+        FastMachineSim.restore(self, snapshot)
+        self.blocks.clear()
+        self.codeMap[:] = bytes(len(self.codeMap))
+
+    def _writeMemory(self, address, value, unsigned=0):
+        FastMachineSim._writeMemory(self, address, value, unsigned)
+        if self.codeMap[address]:
+            self._codeWritten(address)
+
+    def _codeWritten(self, address):
+        self.interpretOnly[address] = 1
+        self.blocks.clear()
+        self.codeMap[:] = bytes(len(self.codeMap))
+
+    def _compileBlock(self, start):
+        body = []
+        entries = []
+        address = start
+        length = 0
+        while True:
+            if (length == self.MAX_BLOCK_LENGTH or not self.MIN_ADDRESS <= address <= self.MAX_ADDRESS
+                    or not self.MM[address] or self.interpretOnly[address]):
+                self.__exit(body, "", address, length)
+                break
+            entry = self.decoded[address] or self._decode(address)
+            op, operand, opcode = entry
+            operation = op.__name__[len("opr_"):]
+            if operation == "DISABLED" or (operation == "LOADID" and self.blockProfiler is not None):
+                self.__exit(body, "", address, length)
+                break
+            entries.append((address, entry))
+            if self.__emit(body, operation, address, operand, length):
+                length += 1
+                break
+            length += 1
+            address += 1
+        if length == 0:
+            self.blocks[start] = False
+            return False
+        source = "def block(sim, MM, U, decoded, codeMap, dirty):\n    acc = sim.ACC\n    accU = sim.accUnsigned\n" + "\n".join(body) + "\n"
+        function = JitMachineSim._codeCache.get(source)
+        if function is None:
+            if len(JitMachineSim._codeCache) >= self.CODE_CACHE_SIZE:
+                JitMachineSim._codeCache.clear()
+            namespace = {}
+            exec(compile(source, "<block %i>" % start, "exec"), namespace)
+            function = JitMachineSim._codeCache[source] = namespace["block"]
+        for address in range(start, start + length):
+            self.codeMap[address] = 1
+        block = self.blocks[start] = (function, length, [0] * (length + 1), entries[:length])
+        if self.blockProfiler is not None:
+            self.profiledBlocks.append(block)
+        return block
+
+    def _setBlockProfiler(self, profiler):
+        # blocks compiled for another profiler (or none) count into the wrong sink or inline LOADID
+        self.blocks.clear()
+        self.codeMap[:] = bytes(len(self.codeMap))
+        self.blockProfiler = profiler
+        self.profiledBlocks = [] # every block compiled for profiler, including dropped ones
+
+    def _flushBlockCounts(self):
+        profiler = self.blockProfiler
+        for block in self.profiledBlocks:
+            counts, blockEntries = block[2], block[3]
+            for executed, count in enumerate(counts):
+                if count:
+                    for address, entry in blockEntries[:executed]:
+                        profiler.count(address, entry, times=count)
+                    counts[executed] = 0
+        self.profiledBlocks = [block for block in self.profiledBlocks if self.blocks.get(block[3][0][0]) is block]
+
+    @staticmethod
+    def __exit(body, indent, nextPC, steps):
+        body.append("%s    sim.ACC = acc\n%s    sim.accUnsigned = accU\n%s    sim.PC = %s\n%s    return %i"
+                    % (indent, indent, indent, nextPC, indent, steps))
+
+    @staticmethod
+    def __signed(word, unsigned):
+        return "(%s if %s or %s < 0x8000 else %s - 0x10000)" % (word, unsigned, word, word)
+
+    def __emit(self, body, operation, address, operand, steps):
+        # appends the code for one instruction, returns True if it ends the block
+        a = operand
+        emit = body.append
+        if operation == "LOAD":
+            emit("    acc = MM[%i]\n    accU = U[%i]" % (a, a))
+        elif operation == "STORE":
+            # inlined _writeMemory
+            emit("    if %i not in dirty:\n        dirty[%i] = %s" % (a, a, self.__signed("MM[%i]" % a, "U[%i]" % a)))
+            emit("    MM[%i] = acc\n    U[%i] = accU\n    decoded[%i] = None\n    if codeMap[%i]:\n        sim._codeWritten(%i)"
+                 % (a, a, a, a, a))
+            self.__exit(body, "    ", address + 1, steps + 1)
+        elif operation in ("ADD", "SUBTRACT", "MULTIPLY"):
+            symbol = {"ADD": "+", "SUBTRACT": "-", "MULTIPLY": "*"}[operation]
+            emit("    acc = (acc %s MM[%i]) & 0xFFFF" % (symbol, a))
+        elif operation == "DIVIDE":
+            # a zero divisor leaves the instruction to the interpreter, which raises the error
+            emit("    divisor = MM[%i]\n    if not divisor:" % a)
+            self.__exit(body, "    ", address, steps)
+            emit("    acc = (%s // %s) & 0xFFFF" % (self.__signed("acc", "accU"), self.__signed("divisor", "U[%i]" % a)))
+        elif operation == "LOADI":
+            emit("    acc = %i\n    accU = 0" % (a & self.DATA_MASK))
+        elif operation == "LOADID":
+            emit("    target = %s\n    if not -0x1000 <= target < 0x1000:" % self.__signed("MM[%i]" % a, "U[%i]" % a))
+            self.__exit(body, "    ", address, steps)
+            emit("    acc = MM[target]\n    accU = U[target]")
+        elif operation == "JUMP":
+            self.__exit(body, "", a, steps + 1)
+            return True
+        elif operation in ("JUMPZERO", "JUMPNEG"):
+            emit("    if acc == 0:" if operation == "JUMPZERO" else "    if not accU and acc & 0x8000:")
+            self.__exit(body, "    ", a, steps + 1)
+            self.__exit(body, "", address + 1, steps + 1)
+            return True
+        elif operation == "JUMPSUB":
+            emit("    sim._writeMemory(%i, %i)" % (a, (address + 1) & self.DATA_MASK))
+            self.__exit(body, "", a + 1, steps + 1)
+            return True
+        elif operation == "RETURN":
+            self.__exit(body, "", self.__signed("MM[%i]" % a, "U[%i]" % a), steps + 1)
+            return True
+        return False
+
+    def _runFinished(self):
+        # block counts go to the profiler before FastMachineSim flushes it
+        if self.blockProfiler is not None and self.blockProfiler is self.activeTrace():
+            self._flushBlockCounts()
+        FastMachineSim._runFinished(self)
+
+    def _blockSteps(self, limit):
+        MM = self.MM
+        blocks = self.blocks
+        profiler = self.blockProfiler
+        steps = 0
+        while steps != limit and MM[self.PC]:
+            block = blocks.get(self.PC)
+            if block is None:
+                block = self._compileBlock(self.PC)
+            if block and (limit is None or steps + block[1] <= limit):
+                executed = block[0](self, MM, self.MMUnsigned, self.decoded, self.codeMap, self.dirty)
+                if executed:
+                    block[2][executed] += 1
+                    steps += executed
+                    continue
+            pc = self.PC
+            entry = self.decoded[pc] or self._decode(pc)
+            op, address, opcode = entry
+            op(self, address)
+            if profiler is not None:
+                profiler.count(pc, entry, self.readMemory(address) if op is FastMachineSim.opr_LOADID else None)
+            steps += 1
+        return steps
+
+    def run(self, reload=False, maxSteps=None, timeLimit=None):
+        profiler = self.activeTrace()
+        if profiler is not None and not profiler.counting:
+            return FastMachineSim.run(self, reload, maxSteps, timeLimit)
+        if profiler is not self.blockProfiler:
+            self._setBlockProfiler(profiler)
+        self._runLoop(self._blockSteps, lambda: self.MM[self.PC], reload, maxSteps, timeLimit)
+
+class VectorMachineSim:
+    # Runs the same program on many independent machine states (lanes) in lockstep using NumPy.
+    # ACC is an int16 vector, PC an int vector and MM a lanes x 4096 uint16 matrix; MMUnsigned and
+    # accUnsigned carry the instruction-word flags of FastMachineSim. Each step groups the active
+    # lanes by the instruction word they are at and applies it to the whole group at once, so lanes
+    # following the same control path cost one NumPy operation per instruction.
+    MIN_ADDRESS = MachineSim.MIN_ADDRESS
+    MAX_ADDRESS = MachineSim.MAX_ADDRESS
+    VALUE_BITS = MachineSim.VALUE_BITS
+
+    # per-lane outcome codes in errors
+    ERROR_NONE = 0
+    ERROR_EXTENSION = 1 # extended instruction while extensions are disabled
+    ERROR_DIVIDE_BY_ZERO = 2
+    ERROR_ADDRESS = 3 # PC or LOADID target outside memory
+    ERROR_NAMES = {ERROR_EXTENSION: "extension disabled", ERROR_DIVIDE_BY_ZERO: "division by zero",
+                   ERROR_ADDRESS: "address out of range"}
+
+    def __init__(self, lanes, extended=True):
+        if numpy is None:
+            raise ImportError("VectorMachineSim requires NumPy")
+        self.lanes = lanes
+        self.extensionsAllowed = extended
+        self.resetRegisters()
+        self.resetRam()
+
+    def resetRegisters(self):
+        self.ACC = numpy.zeros(self.lanes, numpy.int16)
+        self.accRaw = self.ACC.view(numpy.uint16)
+        self.accUnsigned = numpy.zeros(self.lanes, bool)
+        self.PC = numpy.zeros(self.lanes, numpy.int64)
+        self.steps = numpy.zeros(self.lanes, numpy.int64)
+        self.halted = numpy.zeros(self.lanes, bool)
+        self.errors = numpy.zeros(self.lanes, numpy.int8)
+
+    def resetRam(self):
+        size = self.MAX_ADDRESS + 1
+        self.MM = numpy.zeros((self.lanes, size), numpy.uint16)
+        self.MMUnsigned = numpy.zeros((self.lanes, size), bool)
+
+    def loadProgram(self, machineProgram):
+        self.currentProgram = machineProgram
+        self.PC[:] = machineProgram.getStartAddress()
+        for line,ins in machineProgram.getProgramBinary().items():
+            self.MM[:, line] = ins.value & 0xFFFF
+            self.MMUnsigned[:, line] = bool(ins.unsigned)
+
+    def setMemory(self, address, values):
+        # values is one int for every lane or a sequence with one int per lane
+        self.MM[:, address] = numpy.asarray(values, numpy.int64) & 0xFFFF
+        self.MMUnsigned[:, address] = False
+
+    @staticmethod
+    def toSigned(raw, unsigned):
+        raw = raw.astype(numpy.int64)
+        return numpy.where(unsigned | (raw < 0x8000), raw, raw - 0x10000)
+
+    def readMemory(self, address):
+        return self.toSigned(self.MM[:, address], self.MMUnsigned[:, address])
+
+    def readACC(self):
+        return self.toSigned(self.accRaw, self.accUnsigned)
+
+    def running(self):
+        return ~self.halted & (self.errors == self.ERROR_NONE)
+
+    def run(self, reload=False, maxSteps=None):
+        # Steps until every lane has halted or failed, or maxSteps instructions have been
+        # executed; lanes still running() afterwards hit the step limit.
+        if reload:
+            self.resetRam()
+            self.resetRegisters()
+            self.loadProgram(self.currentProgram)
+        operationNames = MachineSim.OPERATION_NAMES
+        step = 0
+        while maxSteps is None or step < maxSteps:
+            lanes = numpy.flatnonzero(self.running())
+            if len(lanes) == 0:
+                break
+            for word, group in groupLanes(self, lanes, self.PC[lanes], self.MAX_ADDRESS + 1,
+                                          lambda lanes, pcs: self.MM[lanes, pcs]):
+                operand = word & 0xFFF
+                if operand & 0x800:
+                    operand -= 0x1000
+                operation = operationNames.get(word >> self.VALUE_BITS, "NOP")
+                self.steps[group] += 1
+                self._execute(operation, group, operand)
+            step += 1
+
+    def _execute(self, operation, lanes, a):
+        MM, MMUnsigned, acc, PC = self.MM, self.MMUnsigned, self.accRaw, self.PC
+        if operation in MachineSim.OPERATIONS_EXTENDED and not self.extensionsAllowed:
+            self.errors[lanes] = self.ERROR_EXTENSION
+            self.steps[lanes] -= 1
+            return
+        if operation == "LOAD":
+            acc[lanes] = MM[lanes, a]
+            self.accUnsigned[lanes] = MMUnsigned[lanes, a]
+        elif operation == "STORE":
+            MM[lanes, a] = acc[lanes]
+            MMUnsigned[lanes, a] = self.accUnsigned[lanes]
+        elif operation == "ADD":
+            acc[lanes] = acc[lanes] + MM[lanes, a]
+        elif operation == "SUBTRACT":
+            acc[lanes] = acc[lanes] - MM[lanes, a]
+        elif operation == "MULTIPLY":
+            acc[lanes] = acc[lanes] * MM[lanes, a]
+        elif operation == "DIVIDE":
+            divisor = self.toSigned(MM[lanes, a], MMUnsigned[lanes, a])
+            failed = divisor == 0
+            if failed.any():
+                self.errors[lanes[failed]] = self.ERROR_DIVIDE_BY_ZERO
+                self.steps[lanes[failed]] -= 1
+                lanes, divisor = lanes[~failed], divisor[~failed]
+            acc[lanes] = numpy.floor_divide(self.toSigned(acc[lanes], self.accUnsigned[lanes]), divisor) & 0xFFFF
+        elif operation == "JUMP":
+            PC[lanes] = a
+            return
+        elif operation == "JUMPZERO":
+            PC[lanes] = numpy.where(acc[lanes] == 0, a, PC[lanes] + 1)
+            return
+        elif operation == "JUMPNEG":
+            PC[lanes] = numpy.where(~self.accUnsigned[lanes] & (acc[lanes] >= 0x8000), a, PC[lanes] + 1)
+            return
+        elif operation == "JUMPSUB":
+            MM[lanes, a] = (PC[lanes] + 1) & 0xFFFF
+            MMUnsigned[lanes, a] = False
+            PC[lanes] = a + 1
+            return
+        elif operation == "RETURN":
+            PC[lanes] = self.toSigned(MM[lanes, a], MMUnsigned[lanes, a])
+            return
+        elif operation == "LOADI":
+            acc[lanes] = a & 0xFFFF
+            self.accUnsigned[lanes] = False
+        elif operation == "LOADID":
+            target = self.toSigned(MM[lanes, a], MMUnsigned[lanes, a])
+            failed = (target < -self.MAX_ADDRESS - 1) | (target > self.MAX_ADDRESS)
+            if failed.any():
+                self.errors[lanes[failed]] = self.ERROR_ADDRESS
+                self.steps[lanes[failed]] -= 1
+                lanes, target = lanes[~failed], target[~failed]
+            acc[lanes] = MM[lanes, target]
+            self.accUnsigned[lanes] = MMUnsigned[lanes, target]
+        PC[lanes] += 1
+
+_lineParser = None
+
+def getLineParser():
+    # One pattern for every program line kind and the opcode of every keyword (Finnish included),
+    # built on first use and shared by all MachineProgram instances. Alternatives are tried in the
+    # order the old per-kind regexes were: data word, operator, bare NOP, comment.
+    global _lineParser
+    if _lineParser is None:
+        operatorCodes = dict(MachineSim.OPERATIONS)
+        for fi, operation in MachineSim.FI_OPER.items():
+            operatorCodes[fi] = MachineSim.OPERATIONS[operation]
+        operatorStr = "|".join(operatorCodes.keys())
+        lineRegex = re.compile(r"\s*(?:([0-9]+)\s+(?:([0-9]+)|(%s)\s+([0-9]+)?|NOP)|(#))" % operatorStr)
+        _lineParser = (lineRegex.match, operatorCodes)
+    return _lineParser
+
+def parseProgramLine(input):
+    # [address, value] for a data word, [address, opcode, operand] for an instruction, None for
+    # blank, comment and special lines and False for a syntax error
+    if len(input.strip())==0:
+        return None
+    match, operatorCodes = getLineParser()
+    match = match(input)
+    if match:
+        address, value, operator, operand, comment = match.groups()
+        if comment is not None:
+            return None
+        address = int(address)
+        if value is not None:
+            return [address, int(value)]
+        if operator is not None:
+            if operand is not None:
+                return [address, operatorCodes[operator], int(operand)]
+            # operator followed by whitespace but no operand, e.g. "10 NOP # comment"
+            if operatorCodes[operator] != MachineSim.OPERATIONS.get("NOP"):
+                return False
+        return [address, MachineSim.OPERATIONS.get("NOP"), 1]
+    if MachineProgram.checkSpecialInstruction(input):
+        return None
+    return False
+
 class MachineProgram:
     MIN_ADDRESS = 0 # -1 used only internally, line never executed
     MAX_ADDRESS = 4095
@@ -451,15 +1175,7 @@ class MachineProgram:
     def __init__(self, input):
         self.rawInput = input
 
-        self.valueRegex = re.compile(r"\s*(?P<address>[0-9]+)\s+(?P<value>[0-9]+)(?P<comment>.*)")
-        operatorStr = "|".join(MachineSim.OPERATIONS.keys()) +"|"+ "|".join(MachineSim.FI_OPER.keys())
-        operatorSyntax = r"\s*(?P<address>[0-9]+)\s+(?P<operator>%s)\s+(?P<value>[0-9]+)?(?P<comment>.*)" % operatorStr
-        shorthandSyntax = r"(?P<operator>%s)\s+(?P<value>[0-9]+)?(?P<comment>.*)" % operatorStr
-        self.operatorRegex = re.compile(operatorSyntax)
-        self.nopRegex = re.compile(r"\s*(?P<address>[0-9]+)\s+(NOP)(?P<comment>.*)")
-        self.commentRegex = re.compile(r"\s*#(?P<comment>.*)")
         self.program = self.parse(input)
-        self.shorthandRegex = re.compile(shorthandSyntax)
 
         self.makeBinary()
 
@@ -491,7 +1207,8 @@ class MachineProgram:
     def getLineStr(self, index):
         return "line " + str(index) + ": \"" + self.rawInput[index] + "\""
 
-    def checkSpecialInstruction(self, instruction):
+    @staticmethod
+    def checkSpecialInstruction(instruction):
         instruction = instruction.strip().upper()
         if instruction == "DEBUG":
             MachineSim.debug = True
@@ -503,37 +1220,12 @@ class MachineProgram:
 
 
     def parseLine(self, input, lineNum):
-        if len(input.strip())==0:
-            return None
-        valueMatch = self.valueRegex.match(input)
-        if(valueMatch):
-            return [int(valueMatch.group("address")), int(valueMatch.group("value"))]
-
-        operatorMatch = self.operatorRegex.match(input)
-        if(operatorMatch):
-            operator = operatorMatch.group("operator")
-            operator = MachineSim.OPERATIONS.get(MachineSim.FI_OPER.get(operator, operator)) 
-            value = int(operatorMatch.group("value"))
-            address = int(operatorMatch.group("address"))
-            self.last_address = address
-            return [address, operator, value]
-        # shorthandMatch = self.shorthandRegex.match(input)
-        # if shorthandMatch:
-        #     operator = shorthandMatch.group("operator")
-        #     value = int(shorthandMatch.group("value"))
-        #     address = self.last_address+1
-        #     self.last_address += 1
-        #     return [address, operator, value]
-        nopMatch = self.nopRegex.match(input)
-
-        if nopMatch:
-            return [int(nopMatch.group("address")), MachineSim.OPERATIONS.get("NOP"), 1]
-        if self.commentRegex.match(input):
-            return None
-        if(self.checkSpecialInstruction(input)):
-            return None
-
-        raise MachineException("Syntax error on line \"" + str(lineNum) + ":" + self.getLineStr(lineNum))
+        parsedLine = parseProgramLine(input)
+        if parsedLine is False:
+            raise MachineException("Syntax error on line \"" + str(lineNum) + ":" + self.getLineStr(lineNum))
+        if parsedLine is not None and len(parsedLine) == 3:
+            self.last_address = parsedLine[0]
+        return parsedLine
 
     def parse(self, input):
         input = [x for x in input.split("\n")]
@@ -552,4 +1244,670 @@ class MachineProgram:
         return program
 
 
+def sourceChecksum(lines):
+    # sha256 of the source lines, each terminated by a newline
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.rstrip("\r\n").encode("utf-8") + b"\n")
+    return digest.digest()
+
+class ProgramImage:
+    # Assembled program in a preallocated 4096-word buffer. words holds the 16-bit words,
+    # instruction marks instruction words (unsigned, like in MachineProgram) and used marks the
+    # addresses the program defines. Works wherever a MachineProgram is loaded.
+    #
+    # save() writes a binary image: a header (magic, format version, start address, source
+    # checksum, used and instruction bitmaps with one bit per address, least significant bit first)
+    # followed by the 4096 words as little-endian 16-bit integers.
+    SIZE = MachineProgram.MAX_ADDRESS + 1
+    OPERATOR_ALIGN = MachineProgram.OPERATOR_ALIGN
+    MAGIC = b"MSIM"
+    FORMAT_VERSION = 1
+    HEADER = struct.Struct("<4sHH32s")
+    BITMAP_BYTES = SIZE // 8
+    IMAGE_BYTES = HEADER.size + 2 * BITMAP_BYTES + 2 * SIZE
+
+    def __init__(self):
+        self.words = array("H", bytes(2 * self.SIZE))
+        self.instruction = bytearray(self.SIZE)
+        self.used = bytearray(self.SIZE)
+        self.start = 0
+        self.checksum = bytes(32)
+        self.programBinary = None
+        self.usedAddresses = None
+        self.mapping = None
+        self.frozen = False
+
+    @classmethod
+    def fromLines(cls, lines):
+        # Parses lines one at a time from any iterable of strings, e.g. an open file. Only the line
+        # being parsed is kept, for the error message.
+        image = cls()
+        digest = hashlib.sha256()
+        for lineNum, line in enumerate(lines):
+            line = line.rstrip("\r\n")
+            digest.update(line.encode("utf-8") + b"\n")
+            parsedLine = parseProgramLine(line)
+            if parsedLine is None:
+                continue
+            if parsedLine is False:
+                raise MachineException("Syntax error on line \"" + str(lineNum) + ":line " + str(lineNum) + ": \"" + line + "\"")
+            address = parsedLine[0]
+            if address < MachineProgram.MIN_ADDRESS or address > MachineProgram.MAX_ADDRESS:
+                raise MachineException("Invalid address on line: " + line)
+            if len(parsedLine) == 2:
+                image.words[address] = parsedLine[1] & 0xFFFF
+                image.instruction[address] = 0
+            else:
+                image.words[address] = ((parsedLine[1] << cls.OPERATOR_ALIGN) | parsedLine[2]) & 0xFFFF
+                image.instruction[address] = 1
+            image.used[address] = 1
+        image.checksum = digest.digest()
+        return image
+
+    @classmethod
+    def fromProgram(cls, machineProgram):
+        image = cls()
+        for address, ins in machineProgram.getProgramBinary().items():
+            image.words[address] = ins.value & 0xFFFF
+            image.instruction[address] = 1 if ins.unsigned else 0
+            image.used[address] = 1
+        image.start = machineProgram.getStartAddress()
+        image.checksum = sourceChecksum(machineProgram.rawInput)
+        return image
+
+    @staticmethod
+    def __packBits(flags):
+        return sum(1 << address for address, flag in enumerate(flags) if flag).to_bytes(ProgramImage.BITMAP_BYTES, "little")
+
+    # byte of a bitmap -> its eight flags
+    BITMAP_FLAGS = [bytes((byte >> bit) & 1 for bit in range(8)) for byte in range(256)]
+
+    @classmethod
+    def __unpackBits(cls, bitmap):
+        return bytearray(b"".join([cls.BITMAP_FLAGS[byte] for byte in bitmap]))
+
+    def save(self, file):
+        # file is a path or a binary file object
+        if isinstance(file, str):
+            with open(file, "wb") as f:
+                return self.save(f)
+        words = array("H", self.words)
+        if sys.byteorder == "big":
+            words.byteswap()
+        file.write(self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION, self.start, self.checksum))
+        file.write(self.__packBits(self.used))
+        file.write(self.__packBits(self.instruction))
+        file.write(words.tobytes())
+
+    @classmethod
+    def load(cls, path, memoryMap=False):
+        # With memoryMap the words are read straight from the mapped file and never copied
+        with open(path, "rb") as f:
+            size = f.seek(0, 2)
+            if size != cls.IMAGE_BYTES:
+                raise ValueError("Corrupt or truncated program image %s: %i bytes, expected %i" % (path, size, cls.IMAGE_BYTES))
+            f.seek(0)
+            if memoryMap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        image = cls()
+        magic, version, image.start, image.checksum = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.FORMAT_VERSION:
+            raise MachineException("Not a program image: " + path)
+        offset = cls.HEADER.size
+        image.used = cls.__unpackBits(data[offset:offset + cls.BITMAP_BYTES])
+        offset += cls.BITMAP_BYTES
+        image.instruction = cls.__unpackBits(data[offset:offset + cls.BITMAP_BYTES])
+        offset += cls.BITMAP_BYTES
+        if memoryMap and sys.byteorder == "little":
+            image.mapping = data
+            image.words = memoryview(data)[offset:offset + 2 * cls.SIZE].cast("H")
+        else:
+            image.words = array("H", bytes(data[offset:offset + 2 * cls.SIZE]))
+            if sys.byteorder == "big":
+                image.words.byteswap()
+            if memoryMap:
+                data.close()
+        return image
+
+    def close(self):
+        if self.mapping is not None:
+            self.words.release()
+            self.mapping.close()
+            self.mapping = None
+
+    def __getstate__(self):
+        # memoryviews and mmaps do not pickle; process pools get a plain copy of the words
+        state = dict(self.__dict__)
+        state["words"] = array("H", self.words)
+        state["mapping"] = None
+        state["programBinary"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.frozen:
+            self.words = memoryview(self.words).toreadonly()
+
+    def addresses(self):
+        if self.usedAddresses is None:
+            self.usedAddresses = [address for address in range(self.SIZE) if self.used[address]]
+        return self.usedAddresses
+
+    def getProgramBinary(self):
+        # NBitInt view for engines that keep memory as NBitInts, built on first use. Read-only
+        # once frozen; the engines copy the NBitInts or, like SparseMemory, never modify them.
+        if self.programBinary is None:
+            self.programBinary = {address: NBitInt(16, self.words[address], unsigned=bool(self.instruction[address]))
+                                  for address in self.addresses()}
+            if self.frozen:
+                self.programBinary = types.MappingProxyType(self.programBinary)
+        return self.programBinary
+
+    def getStartAddress(self):
+        return self.start
 
+    def setStartAddress(self, start):
+        if self.frozen:
+            raise MachineException("Program image is read-only")
+        self.start = start
+
+    def freeze(self):
+        # Read-only from here on, so one image can be shared by any number of machines
+        if not self.frozen:
+            self.words = memoryview(self.words).toreadonly()
+            self.instruction = bytes(self.instruction)
+            self.used = bytes(self.used)
+            if self.programBinary is not None:
+                self.programBinary = types.MappingProxyType(self.programBinary)
+            self.frozen = True
+        return self
+
+def normalizeSource(source):
+    # Program text with comments, blank lines and extra whitespace removed. Sources with the same
+    # normalized text assemble to the same program.
+    lines = []
+    for line in source.split("\n"):
+        line = line.split("#", 1)[0].split()
+        if line:
+            lines.append(" ".join(line))
+    return "\n".join(lines)
+
+class ProgramCache:
+    # LRU cache of assembled programs keyed by a hash of the normalized source. Returns frozen
+    # ProgramImages. Byte-identical sources are found by their raw hash without normalizing.
+    # One image serves every source with the same normalized text, so its checksum is the
+    # sourceChecksum of the normalized lines, not of any one submission's raw text.
+    # Sources with DEBUG or HELP lines are parsed every time for their side effects.
+    def __init__(self, size=256):
+        self.size = size
+        self.programs = OrderedDict()
+        self.sourceKeys = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, source):
+        sourceKey = hashlib.sha256(source.encode("utf-8")).digest()
+        key = self.sourceKeys.get(sourceKey)
+        if key is None:
+            normalized = normalizeSource(source)
+            if any(line.upper() in ("DEBUG", "HELP") for line in normalized.split("\n")):
+                return ProgramImage.fromLines(source.split("\n")).freeze()
+            key = hashlib.sha256(normalized.encode("utf-8")).digest()
+        entry = self.programs.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.programs.move_to_end(key)
+        else:
+            self.misses += 1
+            image = ProgramImage.fromLines(source.split("\n"))
+            image.checksum = sourceChecksum(normalized.splitlines())
+            entry = (image.freeze(), [])
+            if self.size <= 0:
+                return entry[0]
+            self.programs[key] = entry
+        if sourceKey not in self.sourceKeys:
+            self.sourceKeys[sourceKey] = key
+            entry[1].append(sourceKey)
+        self.evict()
+        return entry[0]
+
+    def evict(self):
+        while len(self.programs) > self.size:
+            sourceKeys = self.programs.popitem(last=False)[1][1]
+            for sourceKey in sourceKeys:
+                del self.sourceKeys[sourceKey]
+            self.evictions += 1
+
+    def resize(self, size):
+        self.size = size
+        self.evict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.programs), "size": self.size,
+                "hitRate": self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        self.programs.clear()
+        self.sourceKeys.clear()
+        self.hits = self.misses = self.evictions = 0
+
+programCache = ProgramCache()
+
+def cachedProgram(source):
+    return programCache.get(source)
+
+class ProgramAnalysis:
+    # Static control-flow analysis of a loaded program, without running it. Nodes are the reachable
+    # nonzero words from the start address; execution stops at a zero word (halts) or at an
+    # instruction that may raise (errorExits). RETURN targets are the return points of the
+    # JUMPSUBs to its slot plus the slot's initial value, unless a STORE writes the slot
+    # (unresolved). Results assume the code is not modified at run time (selfModifying).
+    # Nodes are PC values as the engines hold them: operands 2048-4095 are negative, and a negative
+    # PC runs the cell it aliases and continues towards 0, so -1 is followed by 0 while 4095 is
+    # followed by an error exit at 4096. Memory addresses (reads, writes) are cells, 0-4095.
+    ADDRESSES = MachineSim.MAX_ADDRESS + 1
+    NOP, LOAD, STORE, ADD, SUBTRACT, MULTIPLY, DIVIDE, JUMP, JUMPZERO, JUMPNEG, JUMPSUB, RETURN, LOADI, LOADID = (
+        MachineSim.OPERATIONS[name] for name in ("NOP", "LOAD", "STORE", "ADD", "SUBTRACT", "MULTIPLY", "DIVIDE",
+                                                 "JUMP", "JUMPZERO", "JUMPNEG", "JUMPSUB", "RETURN", "LOADI", "LOADID"))
+    READS = (LOAD, ADD, SUBTRACT, MULTIPLY, DIVIDE, RETURN, LOADID)
+    ACC_CONSTANT = (NOP, STORE, JUMP, JUMPZERO, JUMPNEG, JUMPSUB, RETURN)
+
+    def __init__(self, program, extended=True):
+        if isinstance(program, str):
+            program = MachineProgram(program)
+        self.extended = extended
+        binary = program.getProgramBinary()
+        self.words = {address: ins.value & 0xFFFF for address, ins in binary.items()}
+        self.initial = {address: int(ins) for address, ins in binary.items()}
+        self.start = program.getStartAddress() % self.ADDRESSES
+        self.__explore()
+        self.__findLoops()
+
+    def decode(self, address):
+        # (opcode, operand) of the word at address, operand as the signed 12-bit value run uses
+        word = self.words.get(address % self.ADDRESSES, 0)
+        operand = word & 0xFFF
+        if operand >= 0x800:
+            operand -= 0x1000
+        return word >> 12, operand
+
+    def __valueAt(self, address):
+        # the only value address can hold, or None when something writes it
+        if address in self.writes:
+            return None
+        return self.initial.get(address, 0)
+
+    def __explore(self):
+        # Reachability to a fixed point: JUMPSUBs and STOREs found later change RETURN targets
+        # and which memory values are known, so explore again until nothing new is learned
+        self.callSites = {}
+        self.stores = set()
+        self.writes = set()
+        while True:
+            callSites = {slot: set(sites) for slot, sites in self.callSites.items()}
+            writes = set(self.writes)
+            self.__exploreOnce()
+            if self.callSites == callSites and self.writes == writes:
+                break
+
+    def __exploreOnce(self):
+        self.successors = {}
+        self.halts = set()
+        self.errorExits = set()
+        self.unresolved = set()
+        self.reads = set()
+        self.indirectReads = {}
+        pending = [self.start]
+        while pending:
+            address = pending.pop()
+            if address in self.successors or address in self.halts:
+                continue
+            if not -self.ADDRESSES <= address < self.ADDRESSES:
+                self.errorExits.add(address)
+                continue
+            if not self.words.get(address % self.ADDRESSES, 0):
+                self.halts.add(address)
+                continue
+            successors = self.__step(address)
+            self.successors[address] = successors
+            pending.extend(successors)
+
+    def __step(self, address):
+        opcode, operand = self.decode(address)
+        target = operand % self.ADDRESSES
+        nextAddress = (address + 1,)
+        if opcode in self.READS:
+            self.reads.add(target)
+        if opcode in (self.LOADI, self.LOADID) and not self.extended:
+            self.errorExits.add(address)
+            return ()
+        if opcode == self.STORE:
+            self.stores.add(target)
+            self.writes.add(target)
+        elif opcode == self.DIVIDE:
+            if self.__valueAt(target) in (0, None):
+                self.errorExits.add(address)
+        elif opcode == self.LOADID:
+            indirect = self.__valueAt(target)
+            self.indirectReads[target] = indirect
+            if indirect is None or not -self.ADDRESSES <= indirect < self.ADDRESSES:
+                self.errorExits.add(address)
+            else:
+                self.reads.add(indirect % self.ADDRESSES)
+        elif opcode == self.JUMP:
+            return (operand,)
+        elif opcode in (self.JUMPZERO, self.JUMPNEG):
+            return (operand, address + 1)
+        elif opcode == self.JUMPSUB:
+            self.writes.add(target)
+            self.callSites.setdefault(target, set()).add(address)
+            return (operand + 1,)
+        elif opcode == self.RETURN:
+            if target in self.stores:
+                self.unresolved.add(address)
+                return ()
+            returnPoints = {site + 1 for site in self.callSites.get(target, ())}
+            returnPoints.add(self.initial.get(target, 0))
+            if any(not -self.ADDRESSES <= point < self.ADDRESSES for point in returnPoints):
+                self.errorExits.add(address)
+            return tuple(sorted(point for point in returnPoints if -self.ADDRESSES <= point < self.ADDRESSES))
+        return nextAddress
+
+    def __findLoops(self):
+        # Tarjan's strongly connected components, iteratively
+        index = {}
+        lowLink = {}
+        stack = []
+        onStack = set()
+        self.components = []
+        for root in self.successors:
+            if root in index:
+                continue
+            work = [(root, iter(self.successors[root]))]
+            index[root] = lowLink[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in self.successors:
+                        continue
+                    if child not in index:
+                        index[child] = lowLink[child] = len(index)
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append((child, iter(self.successors[child])))
+                        break
+                    if child in onStack:
+                        lowLink[node] = min(lowLink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowLink[parent] = min(lowLink[parent], lowLink[node])
+                    if lowLink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            onStack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        self.components.append(sorted(component))
+        # components come out in reverse topological order
+        self.loops = [component for component in self.components
+                      if len(component) > 1 or component[0] in self.successors[component[0]]]
+
+    @property
+    def reachable(self):
+        return sorted(self.successors)
+
+    @property
+    def selfModifying(self):
+        # written cells that run as code, including the zero words taken as halts
+        code = {address % self.ADDRESSES for address in self.successors}
+        code.update(address % self.ADDRESSES for address in self.halts)
+        return sorted(self.writes & code)
+
+    def exits(self, component):
+        members = set(component)
+        return [address for address in component
+                if address in self.errorExits or address in self.unresolved
+                or any(successor not in members for successor in self.successors[address])]
+
+    @property
+    def infiniteLoops(self):
+        # loops with no way out: once entered, the program never stops
+        if self.selfModifying:
+            return []
+        return [loop for loop in self.loops if not self.exits(loop)]
+
+    @property
+    def invariantLoops(self):
+        # loops that do not change ACC, so every branch in them goes the same way on each pass:
+        # execution leaves them before completing a cycle or never leaves them
+        if self.selfModifying:
+            return []
+        return [loop for loop in self.loops
+                if all(self.decode(address)[0] in self.ACC_CONSTANT and self.decode(address)[0] != self.RETURN
+                       for address in loop)]
+
+    @property
+    def mayHalt(self):
+        return bool(self.halts or self.errorExits or self.unresolved or self.selfModifying)
+
+    def stepBudget(self, iterations=10000):
+        # Upper bound for the instructions of one run when each loop runs at most iterations times:
+        # the longest path through the components, a loop counting as its size times iterations
+        longest = {}
+        for component in self.components:
+            members = set(component)
+            cost = len(component) * (iterations if component in self.loops else 1)
+            after = [longest[successor] for address in component for successor in self.successors[address]
+                     if successor not in members and successor in longest]
+            for address in component:
+                longest[address] = cost + max(after, default=0)
+        return longest.get(self.start, 0)
+
+    def touched(self):
+        return {"reads": sorted(self.reads), "writes": sorted(self.writes),
+                "indirect": sorted(slot for slot, target in self.indirectReads.items() if target is None)}
+
+    def report(self):
+        return {
+            "reachable": self.reachable,
+            "halts": sorted(self.halts),
+            "errorExits": sorted(self.errorExits),
+            "unresolved": sorted(self.unresolved),
+            "selfModifying": self.selfModifying,
+            "loops": self.loops,
+            "infiniteLoops": self.infiniteLoops,
+            "invariantLoops": self.invariantLoops,
+            "mayHalt": self.mayHalt,
+            "touched": self.touched(),
+        }
+
+def analyzeProgram(program, extended=True):
+    return ProgramAnalysis(program, extended)
+
+BatchResults = namedtuple("BatchResults", "addresses rows errors")
+
+_batchMachine = None
+_batchProgram = None
+_batchAddresses = ()
+
+def _newMachine(engine, extended, maxSteps, timeLimit):
+    sim = engine(extended)
+    sim.maxSteps = maxSteps
+    sim.timeLimit = timeLimit
+    sim.raiseErrors = True
+    return sim
+
+def _runCase(sim, program, memory, addresses):
+    sim.resetRam()
+    sim.resetRegisters()
+    sim.loadProgram(program)
+    for address, value in (memory.items() if hasattr(memory, "items") else memory):
+        sim.setMemory(address, value)
+    if addresses is None:
+        sim.markClean()
+        sim.run()
+        return sim.memoryDelta()
+    sim.run()
+    return tuple(sim.readMemory(address) for address in addresses)
+
+def _initBatchWorker(program, engine, extended, addresses, maxSteps=None, timeLimit=None):
+    global _batchMachine, _batchProgram, _batchAddresses
+    _batchMachine = _newMachine(engine, extended, maxSteps, timeLimit)
+    _batchProgram = program
+    _batchAddresses = addresses
+
+def _runBatchCase(memory):
+    try:
+        return _runCase(_batchMachine, _batchProgram, memory, _batchAddresses), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+def runBatch(program, memoryVectors, readAddresses, processes=None, engine=FastMachineSim, extended=True, chunksize=1,
+             maxSteps=None, timeLimit=None):
+    # Runs one program against many memory initialisations. Each vector is a dict or a list of
+    # (address, value) pairs applied after loading the program; rows[i] holds the values of
+    # readAddresses after case i, or None if the case raised (message in errors[i]). With
+    # readAddresses=None a row is the memoryDelta() of the run, the cells it changed.
+    # maxSteps and timeLimit are applied to every case, see MachineSim.run.
+    if isinstance(program, str):
+        program = MachineProgram(program)
+    addresses = None if readAddresses is None else tuple(readAddresses)
+    initArgs = (program, engine, extended, addresses, maxSteps, timeLimit)
+    if processes == 1:
+        _initBatchWorker(*initArgs)
+        results = [_runBatchCase(memory) for memory in memoryVectors]
+    else:
+        with multiprocessing.Pool(processes, _initBatchWorker, initArgs) as pool:
+            results = pool.map(_runBatchCase, memoryVectors, chunksize)
+    rows = [row for row, error in results]
+    errors = {i: error for i, (row, error) in enumerate(results) if error is not None}
+    return BatchResults(addresses, rows, errors)
+
+
+# Values at the edges of 16-bit two's complement, tried before random inputs
+BOUNDARY_VALUES = (-32768, -32767, -1, 0, 1, 32766, 32767)
+
+EquivalenceResult = namedtuple("EquivalenceResult", "equivalent tested counterexample expected actual")
+
+_equivalenceMachine = None
+_equivalencePrograms = ()
+_equivalenceAddresses = ()
+
+def generateInputVectors(inputAddresses, count=200, seed=0, boundaryValues=BOUNDARY_VALUES):
+    # Boundary combinations first (all of them if they fit in half the budget, otherwise each
+    # address alone), then random values, half of them small. Returns at most count dicts.
+    addresses = list(inputAddresses)
+    if not addresses:
+        return [{}]
+    vectors = []
+    seen = set()
+    def add(values):
+        values = tuple(values)
+        if values not in seen:
+            seen.add(values)
+            vectors.append(dict(zip(addresses, values)))
+    if len(boundaryValues) ** len(addresses) <= count // 2:
+        for values in itertools.product(boundaryValues, repeat=len(addresses)):
+            add(values)
+    else:
+        for value in boundaryValues:
+            add([value] * len(addresses))
+        for i in range(len(addresses)):
+            for value in boundaryValues:
+                values = [0] * len(addresses)
+                values[i] = value
+                add(values)
+    rng = random.Random(seed)
+    while len(vectors) < count:
+        add([rng.randint(-100, 100) if rng.random() < 0.5 else rng.randint(-32768, 32767) for address in addresses])
+    return vectors[:count]
+
+def _initEquivalenceWorker(programs, engine, extended, addresses, maxSteps, timeLimit):
+    global _equivalenceMachine, _equivalencePrograms, _equivalenceAddresses
+    _equivalenceMachine = _newMachine(engine, extended, maxSteps, timeLimit)
+    _equivalencePrograms = programs
+    _equivalenceAddresses = addresses
+
+def _compareCase(memory):
+    # (student outcome, reference outcome); an outcome is the output values or the error type
+    outcomes = []
+    for program in _equivalencePrograms:
+        try:
+            outcomes.append(_runCase(_equivalenceMachine, program, memory, _equivalenceAddresses))
+        except Exception as e:
+            outcomes.append(type(e).__name__)
+    return tuple(outcomes)
+
+def _simplerValues(value):
+    # candidates strictly closer to zero than value, simplest first
+    magnitude = abs(value)
+    sign = 1 if value > 0 else -1
+    candidates = [0] if value else []
+    for shift in range(magnitude.bit_length() - 1, 0, -1):
+        candidate = sign * (magnitude >> shift)
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+def _shrinkCounterexample(memory):
+    memory = dict(memory)
+    changed = True
+    while changed:
+        changed = False
+        for address, value in list(memory.items()):
+            for candidate in _simplerValues(value):
+                trial = dict(memory)
+                trial[address] = candidate
+                actual, expected = _compareCase(trial)
+                if actual != expected:
+                    memory = trial
+                    changed = True
+                    break
+    return memory
+
+def checkEquivalence(student, reference, inputAddresses, outputAddresses, vectors=None, count=200, seed=0,
+                     processes=None, engine=FastMachineSim, extended=True, maxSteps=100000, timeLimit=None, chunksize=8):
+    # Runs both programs (parsed once, MachineProgram or source text) on the same inputs and compares
+    # the words at outputAddresses; errors compare by type, so two programs that both hit maxSteps
+    # agree, and a program stopped by a machine error has that error as its outcome instead of its
+    # partial memory. Stops at the first divergence, shrinks its inputs towards zero while the
+    # programs still disagree and reports that counterexample with the reference (expected) and
+    # student (actual) outcomes.
+    programs = tuple(MachineProgram(program) if isinstance(program, str) else program for program in (student, reference))
+    if vectors is None:
+        vectors = generateInputVectors(inputAddresses, count, seed)
+    vectors = [dict(vector) for vector in vectors]
+    initArgs = (programs, engine, extended, tuple(outputAddresses), maxSteps, timeLimit)
+
+    def firstDivergence(results):
+        tested = 0
+        for vector, (actual, expected) in zip(vectors, results):
+            tested += 1
+            if actual != expected:
+                return tested, vector
+        return tested, None
+
+    if processes == 1:
+        _initEquivalenceWorker(*initArgs)
+        tested, counterexample = firstDivergence(map(_compareCase, vectors))
+    else:
+        with multiprocessing.Pool(processes, _initEquivalenceWorker, initArgs) as pool:
+            tested, counterexample = firstDivergence(pool.imap(_compareCase, vectors, chunksize))
+    if counterexample is None:
+        return EquivalenceResult(True, tested, None, None, None)
+    _initEquivalenceWorker(*initArgs)
+    counterexample = _shrinkCounterexample(counterexample)
+    actual, expected = _compareCase(counterexample)
+    return EquivalenceResult(False, tested, counterexample, expected, actual)
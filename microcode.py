@@ -1,216 +1,35 @@
-#encoding: utf-8
-import operator
-
-class NBitInt:
-    def __init__(self, bits, num=0, unsigned=False):
-        self.value = num
-        self.bits = bits
-        self.bitmask = 2**bits-1
-        self.unsigned = unsigned
-
-        if num < 0:
-            self.value = abs(num)
-            self.value = NBitInt.__complement_impl(self.bits, self.value)
-
-    def __signBit(self):
-        if not self.unsigned:
-            return (self.value >> (self.bits-1)) & 1
-        return 0 # treat first bit as data bit
-
-    def isSigned(self):
-        return self.__signBit() != 0
-
-    def isZero(self):
-        return self.value == 0
-
-    def splitToArray(self, *args):
-        if sum(args) != self.bits:
-            raise ValueError("Invalid params: " + repr(args))
-        result = []
-        mask = self.bitmask
-
-        cumulBits = 0
-        for bits in args:
-            num = (self.value << cumulBits) & self.bitmask #discard high order bits
-            num = num >> (self.bits - bits)
-            cumulBits += bits
-            result.append(num)
-
-        return result
-
-    def copy(self):
-        return NBitInt(self.bits,int(self),self.unsigned)
-
-#OPERATORS
-#ARITHMETIC
-    @staticmethod
-    def __add_impl(x, y, bitmask):
-        return (x+y) & bitmask
-
-    def __add__(self, other):
-        other = int(other)
-        return NBitInt(self.bits,
-                       NBitInt.add_impl(self.value, other.value, self.bitmask),
-                       unsigned=self.unsigned)
-
-    def __iadd__(self, other):
-        other = int(other)
-        self.value = NBitInt.__add_impl(self.value, other, self.bitmask)
-        return self
-
-    @staticmethod
-    def __subtract_impl(lhs, rhs):
-        rhs = -rhs
-        result = lhs + rhs
-        return result
-
-    def __sub__(self, other):
-        return NBitInt.subtract_impl(self, other)
-
-    def __isub__(self, other):
-        other = -other
-        self += other
-        return self
-
-    @staticmethod
-    def __multiply_impl(bitmask, x, y):
-        return (x*y) & bitmask
-
-    def __mul__(self, other):
-        other = int(other)
-        return NBitInt(self.bits,
-                       NBitInt.multiply_impl(self.bitmask, self.value, other),
-                       unsigned=self.unsigned)
-
-    def __imul__(self, other):
-        other = int(other)
-        self.value = NBitInt.__multiply_impl(self.bitmask, self.value, other)
-        return self
-
-    @staticmethod
-    def __complement_impl(bits, y):
-        return 2**bits - y
+#coding: utf-8
+import random as random
+import re
+import multiprocessing
+from array import array
+from collections import namedtuple
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # VectorMicroSim is unavailable without NumPy
 
-    def __neg__(self):
-        value = NBitInt.__complement_impl(self.bits, self.value)
-        return NBitInt(self.bits, value, unsigned=self.unsigned)
+try:
+    NBitInt # already defined when nbitint.py is bundled in front of this file
+except NameError:
+    from nbitint import NBitInt, NBitArray, groupLanes
 
-    @staticmethod
-    def __divide_impl(x, y):
-        x,y = map(int, (x,y))
-        result = x//y
-        return result
+SIMULATOR_VERSION = "6"
+SUPER_DEBUG = False # for debugging the simulator itself
 
-    def __floordiv__(self, other):
-        value = NBitInt.divide_impl(self.value, other)
-        return NBitInt(self.bits, value, unsigned=self.unsigned)
 
-    def __ifloordiv__(self, other):
-        value = NBitInt.__divide_impl(self.value, other)
-        if value < 0:
-            value = self.complement_impl(value)
+class MicroException(Exception):
+    def __init__(self, value):
         self.value = value
-        return self
-
-#END ARITHMETIC OPERATORS
-
-#SHIFT OPERATORS
-
-    def __lshift_impl(self, num):
-        return (self.value << num) & self.bitmask
-
-    def __lshift__(self, num):
-        return NBitInt(self.bits, self.__lshift_impl(num), unsigned=self.unsigned)
-
-    def __ilshift__(self, num):
-        self.value = self.__lshift_impl(num)
-        return self
-
-    def __rshift__(self, num):
-        return NBitInt(self.bits, self.value >> num, unsigned=self.unsigned)
-
-    def __irshift__(self, num):
-        self.value >>= num
-        return self
-
-    #If one of the operands is unsigned, the result will also be. The result has as many bits as the largest operand
-    @staticmethod
-    def binop_impl(num1, num2, oper):
-        isNbit = [isinstance(x, NBitInt) for x in [num1, num2]]
-        bits = 16
-        unsigned = True
-        val1 = val2 = 0
-        if all(isNbit):
-            bits = max(num1.bits, num2.bits)
-            unsigned = num1.unsigned | num2.unsigned
-            val1, val2 = num1.value, num2.value
-        elif any(isNbit):
-            if isNbit[1]:
-                num1,num2 = num2,num1 #swap
-            val1, val2 = num1.value, num2
-            bits = num1.bits
-            unsigned = num1.unsigned
-        val = oper(val1, val2)
-        return NBitInt(bits, num=val, unsigned=unsigned)
-
-    def __and__(self, other):
-        return NBitInt.binop_impl(self, other, operator.__and__)
-
-    def __iand__(self, other):
-        self.value = NBitInt.binop_impl(self, other, operator.__and__).value
-        return self
-
-    def __or__(self, other):
-        return NBitInt.binop_impl(self, other, operator.__or__)
-
-    def __ior__(self, other):
-        self.value = NBitInt.binop_impl(self, other, operator.__or__).value
-        return self
-
-    def __xor__(self, other):
-        return NBitInt.binop_impl(self, other, operator.__xor__)
-
-    def __ixor__(self, other):
-        self.value = NBitInt.binop_impl(self, other, operator.__ixor__).value
-        return self
-
-#Unary operators
-    def __invert__(self):
-        return NBitInt(self.bits, num=(self.bitmask - self.value), unsigned=self.unsigned)
-
-    def __pos__(self):
-        return self.copy()
-#End unary operators
-
-#Built-in functions
-    def __abs__(self):
-        return NBitInt(self.bits, num=abs(self.value))
-
-    def __int__(self):
-        if self.isSigned():
-            return -NBitInt.__complement_impl(self.bits, self.value)
-        return self.value
-
-    def __oct__(self):
-        return oct(self.value)
-
-    def __hex__(self):
-        return hex(self.value)
-
-    #Not actually built-in, but it fits here
-    def bin(self):
-        return bin(self.value)
-
     def __str__(self):
-        return str(int(self))#coding: utf-8
-import random as random
-import re
-
-import operator
-SIMULATOR_VERSION = "6"
-SUPER_DEBUG = False # for debugging the simulator itself
+        return repr(self.value)
 
+class InfiniteMicroLoop(MicroException):
+    def __init__(self, value, MPC, cycles):
+        MicroException.__init__(self, value)
+        self.MPC = MPC
+        self.cycles = cycles
 
 
 class MicroSim:
@@ -220,20 +39,34 @@ class MicroSim:
     MIR_WIDTH = 22
     zeroInstruction = "0" * MIR_WIDTH
     MPC_WIDTH = 8
-    DATA_ONE = NBitInt(DATA_BITS, 1)
-    DATA_TWO = NBitInt(DATA_BITS, 2)
-
-    def __init__(self, microProgram=None):
-
+    DATA_ZERO = NBitInt.interned(DATA_BITS, 0)
+    DATA_ONE = NBitInt.interned(DATA_BITS, 1)
+    DATA_TWO = NBitInt.interned(DATA_BITS, 2)
+    # CC[cc] is the bit of control signal cc in an integer microinstruction, cc 1 being the highest bit
+    CC = tuple(1 << shift for shift in range(MIR_WIDTH, -1, -1))
+    _cycleCache = {} # microinstruction word -> compiled cycle, shared by all instances
+    CYCLE_CACHE_SIZE = 4096
+    maxCycles = None # cycles per execute, None = unlimited
+    detectLoops = False # stop when a (MPC, A, B, C, D, MDR, MAR) state repeats, see execute
+
+    def __init__(self, microProgram=None, quiet=False):
+        # quiet ignores the debug settings of microProgram, for batch runs
+        self.printClocks = False
+        self.debug = False
         self.resetRegisters()
         self.resetMPC()
         self.MPM = [self.zeroInstruction for x in range(0, 256)]
-        self.MM = [NBitInt(self.DATA_BITS) for x in range(0, 4096)]
+        self.MPM_WORDS = [0] * 256 # MPM as integers, see MicroProgram.getWords
+        self.cycles = [self.compileCycle(0)] * 256
+        self.resetMemory()
 
         if microProgram != None:
             self.MPM = [[str(x) for x in y] for y in microProgram.MPM]
-            self.printClocks = microProgram.more_debug
-            self.debug = microProgram.debug
+            self.MPM_WORDS = microProgram.getWords()
+            self.cycles = microProgram.getCycles()
+            if not quiet:
+                self.printClocks = microProgram.more_debug
+                self.debug = microProgram.debug
 
         self.resetBus(True, True, True)
 
@@ -250,6 +83,7 @@ class MicroSim:
 
     def resetMIR(self):
         self.MIR_INS = self.MPM[0]
+        self.MIR_WORD = self.MPM_WORDS[0]
 
     def resetRegisters(self):
         self.A = NBitInt(self.DATA_BITS)
@@ -259,74 +93,93 @@ class MicroSim:
         self.MDR = NBitInt(self.DATA_BITS)
         self.MAR = NBitInt(self.MAR_WIDTH, unsigned=True)
 
+    def resetMemory(self):
+        self.MM = NBitArray(self.DATA_BITS, 4096)
+
     def resetMPC(self):
         self.MPC = NBitInt(self.MPC_WIDTH, unsigned=True)
 
+    # DATA_ZERO, DATA_ONE and DATA_TWO are interned and so immutable, idle buses can share them
     def clock1(self):
-        MIR = self.MIR
-        self.resetBus(True, True, True)
-        for i in range(1, 5):
-            if MIR(i):
-                self.V2 = self.getABCD_complement()[i - 1]
-        if MIR(5):
-            self.V1 = self.DATA_ONE
-        if MIR(6):
-            self.V1 = self.MDR
+        word = self.MIR_WORD
+        CC = self.CC
+        V1 = V2 = self.DATA_ZERO
+        if word & CC[1]:
+            V2 = self.A
+        if word & CC[2]:
+            V2 = self.B
+        if word & CC[3]:
+            V2 = self.C
+        if word & CC[4]:
+            V2 = self.D
+        if word & CC[5]:
+            V1 = self.DATA_ONE
+        if word & CC[6]:
+            V1 = self.MDR
+        self.V1 = V1
+        self.V2 = V2
 
         # Alu
-        self.V3 = self.executeALU(self.V1, self.V2, MIR(7), MIR(8))
+        self.V3 = self.executeALU(V1, V2, word & CC[7], word & CC[8])
 
     def clock2(self):
-        MIR = self.MIR
-        if MIR(9):
+        word = self.MIR_WORD
+        CC = self.CC
+        if word & CC[9]:
             self.A = self.V3.copy()
-        if MIR(10):
+        if word & CC[10]:
             self.B = self.V3.copy()
-        if MIR(11):
+        if word & CC[11]:
             self.C = self.V3.copy()
-        if MIR(12):
+        if word & CC[12]:
             self.D = self.V3.copy()
-        if MIR(13):
+        if word & CC[13]:
             self.MDR = self.V3.copy()
-        if MIR(14):
+        if word & CC[14]:
             discarded, marValue = self.V3.splitToArray(4,12)
             self.MAR = NBitInt(self.MAR_WIDTH, marValue, unsigned=True)
 
     def clock3(self):
-        MIR = self.MIR
-        if MIR(15):
-            self.MDR = self.MM[int(self.MAR)]
-        if MIR(16):
-            self.MM[int(self.MAR)] = self.MDR
+        word = self.MIR_WORD
+        if word & self.CC[15]:
+            self.MDR = self.MM.nbit(int(self.MAR))
+        if word & self.CC[16]:
+            self.MM.set(int(self.MAR), self.MDR.value)
 
     def clock4(self):
-        MIR = self.MIR
-        self.resetBus(True, True, True)
-
-        if MIR(17):
-            self.V1 = self.DATA_ONE
-        if MIR(18):
-            self.V1 = NBitInt(self.DATA_BITS, int("".join(self.MIR_INS[:8]),2))
-        if MIR(19):
+        word = self.MIR_WORD
+        CC = self.CC
+        V1 = self.DATA_ZERO
+        V2 = self.DATA_ZERO
+
+        if word & CC[17]:
+            V1 = self.DATA_ONE
+        if word & CC[18]:
+            V1 = NBitInt(self.DATA_BITS, word >> (self.MIR_WIDTH - 8)) # control bits 1-8 as a number
+        if word & CC[19]:
             if self.A.isZero():
-                self.V1 = self.DATA_ONE
+                V1 = self.DATA_ONE
             else:
-                self.V1 = self.DATA_TWO
-        if MIR(20):
+                V1 = self.DATA_TWO
+        if word & CC[20]:
             if self.A.isSigned():
-                self.V1 = self.DATA_ONE
+                V1 = self.DATA_ONE
             else:
-                self.V1 = self.DATA_TWO
-        if MIR(21):
+                V1 = self.DATA_TWO
+        if word & CC[21]:
             highOrderBits = self.MDR.splitToArray(4, self.DATA_BITS-4)[0]
-            self.V1 = NBitInt(self.DATA_BITS, highOrderBits)
-        if MIR(22):
-            self.V2 = self.MPC
-        self.V3 = self.executeALU(self.V1, self.V2, 0, 0)
+            V1 = NBitInt(self.DATA_BITS, highOrderBits)
+        if word & CC[22]:
+            V2 = self.MPC
+        self.V1 = V1
+        self.V2 = V2
+        self.V3 = self.executeALU(V1, V2, 0, 0)
 
     def clock5(self):
         self.MPC = self.V3.copy()
-        self.MIR_INS = self.MPM[int(self.MPC)]
+        address = int(self.MPC)
+        self.MIR_INS = self.MPM[address]
+        self.MIR_WORD = self.MPM_WORDS[address]
 
     def executeALU(self, v1, v2, complement, x2):
         result = NBitInt(self.DATA_BITS, int(v1))
@@ -341,13 +194,80 @@ class MicroSim:
     def clocks(self):
         return [self.clock1, self.clock2, self.clock3, self.clock4, self.clock5]
 
+    @classmethod
+    def compileCycle(cls, word):
+        # A function doing clocks 1-5 for one microinstruction: only the active transfers are
+        # generated and the ALU flags are folded into the expression. It returns the next MPM
+        # address and leaves MIR to the caller. The V1 and V2 buses are not updated.
+        function = cls._cycleCache.get(word)
+        if function is not None:
+            return function
+        CC = cls.CC
+        mask = cls.DATA_BIT_MASK
+        body = []
+        targets = [register for cc, register in zip(range(9, 14), ("A", "B", "C", "D", "MDR")) if word & CC[cc]]
+        if targets or word & CC[14]:
+            # clock1 and the ALU
+            v1 = "0"
+            v2 = "0"
+            for cc, register in zip(range(1, 5), ("A", "B", "C", "D")):
+                if word & CC[cc]:
+                    v2 = "sim.%s.value" % register
+            if word & CC[5]:
+                v1 = "1"
+            if word & CC[6]:
+                v1 = "sim.MDR.value"
+            if word & CC[7]:
+                v1 = "-" + v1
+            body.append("    v3 = (%s + %s) & %i" % (v1, v2, mask))
+            if word & CC[8]:
+                body.append("    v3 = (v3 << 1) & %i" % mask)
+            # clock2, the registers can share one value as NBitInts are never modified in place
+            if targets:
+                body.append("    sim.%s = NBitInt(%i, v3)" % (" = sim.".join(targets), cls.DATA_BITS))
+            if word & CC[14]:
+                body.append("    sim.MAR = NBitInt(%i, v3 & %i, unsigned=True)" % (cls.MAR_WIDTH, (1 << cls.MAR_WIDTH) - 1))
+        # clock3
+        if word & CC[15]:
+            body.append("    sim.MDR = MM.nbit(sim.MAR.value)")
+        if word & CC[16]:
+            body.append("    MM.set(sim.MAR.value, sim.MDR.value)")
+        # clock4
+        v1 = "0"
+        if word & CC[17]:
+            v1 = "1"
+        if word & CC[18]:
+            v1 = str(word >> (cls.MIR_WIDTH - 8))
+        if word & CC[19]:
+            v1 = "(1 if sim.A.isZero() else 2)"
+        if word & CC[20]:
+            v1 = "(1 if sim.A.isSigned() else 2)"
+        if word & CC[21]:
+            v1 = "((sim.MDR.value & %i) >> %i)" % (mask, cls.DATA_BITS - 4)
+        v2 = "sim.MPC.value" if word & CC[22] else "0"
+        # clock5
+        body.append("    sim.MPC = sim.V3 = mpc = NBitInt(%i, (%s + %s) & %i)" % (cls.DATA_BITS, v1, v2, mask))
+        body.append("    return int(mpc)")
+        source = "def cycle(sim, MM):\n" + "\n".join(body) + "\n"
+        namespace = {"NBitInt": NBitInt}
+        exec(compile(source, "<microinstruction %i>" % word, "exec"), namespace)
+        if len(cls._cycleCache) >= cls.CYCLE_CACHE_SIZE:
+            cls._cycleCache.clear()
+        function = cls._cycleCache[word] = namespace["cycle"]
+        return function
+
     def executeCycle(self):
+        if not (self.printClocks or self.debug):
+            address = self.compileCycle(self.MIR_WORD)(self, self.MM)
+            self.MIR_INS = self.MPM[address]
+            self.MIR_WORD = self.MPM_WORDS[address]
+            return
         if self.printClocks:
-            print ("Executing address[" + str(self.MPC)) + "] MIR=" + "".join(self.MIR_INS[:8]) + " "\
-                ""+"".join(self.MIR_INS[8:14]) + " " + "".join(self.MIR_INS[14:16]) + " " + "".join(self.MIR_INS[16:])
+            print ("Executing address[" + str(self.MPC) + "] MIR=" + "".join(self.MIR_INS[:8]) + " "\
+                ""+"".join(self.MIR_INS[8:14]) + " " + "".join(self.MIR_INS[14:16]) + " " + "".join(self.MIR_INS[16:]))
 
-        for i in range(0, 5):
-            self.clocks()[i]()
+        for i, clock in enumerate(self.clocks()):
+            clock()
             if self.printClocks:
                 print ("After clock", (i + 1), ":")
                 self.printState()
@@ -360,26 +280,71 @@ class MicroSim:
         print (self.printRegisters(*[True for x in range(7)]))
 
     def MIR(self, cc):
-        return int(self.MIR_INS[cc - 1])
+        return (self.MIR_WORD >> (self.MIR_WIDTH - cc)) & 1
 
 
 
     def aluTest(self):
         print (self.executeALU(self.DATA_ONE,self.DATA_ONE,0,0).copy())
 
-    def execute(self):
+    def limitExceeded(self, reason, cycles):
+        return InfiniteMicroLoop("Loputon mikrosilmukka: %s (MPC=%i, %i sykliä)" % (reason, int(self.MPC), cycles),
+                                 int(self.MPC), cycles)
+
+    def execute(self, maxCycles=None, detectLoops=None):
+        # With detectLoops every cycle records the registers; as they and the memory are the
+        # whole state, a repeated state proves the microprogram never ends. A memory write that
+        # changes a cell forgets the recorded states.
         self.resetBus()
         self.resetMPC()
         self.resetMIR()
-        if self.debug or self.printClocks:
+        maxCycles = self.maxCycles if maxCycles is None else maxCycles
+        detectLoops = self.detectLoops if detectLoops is None else detectLoops
+        interpreted = self.debug or self.printClocks
+        if interpreted:
             print ("State before execution:")
             self.printState()
-        while (True):
-            if ("".join(self.MIR_INS) == self.zeroInstruction):
-                if self.printClocks:
-                    print ("Microprogram ended.")
+        # Compiled cycles unless printing, MIR is updated only when the loop ends
+        words = self.MPM_WORDS
+        cycles = self.cycles
+        MM = self.MM
+        memoryWrite = self.CC[16]
+        if detectLoops:
+            states = set()
+            memory = list(MM)
+        address = 0
+        cycleCount = 0
+        error = None
+        while words[address]:
+            if cycleCount == maxCycles:
+                error = self.limitExceeded("sykliraja ylittyi", cycleCount)
                 break
-            self.executeCycle()
+            if detectLoops:
+                state = (self.MPC.value, self.A.value, self.B.value, self.C.value, self.D.value,
+                         self.MDR.value, self.MAR.value)
+                if state in states:
+                    error = self.limitExceeded("tila toistui", cycleCount)
+                    break
+                states.add(state)
+                word = words[address]
+            if interpreted:
+                self.executeCycle()
+                address = int(self.MPC)
+            else:
+                address = cycles[address](self, MM)
+            cycleCount += 1
+            if detectLoops and word & memoryWrite:
+                marValue = self.MAR.value
+                if memory[marValue] != MM[marValue]:
+                    memory[marValue] = MM[marValue]
+                    states.clear()
+        self.MIR_INS = self.MPM[address]
+        self.MIR_WORD = words[address]
+        if error is not None:
+            raise error
+        if self.printClocks:
+            print ("Microprogram ended.")
+        return cycleCount
 
     def setA(self, num):
         self.A = NBitInt(self.DATA_BITS, num)
@@ -409,9 +374,9 @@ class MicroSim:
         self.MDR = NBitInt(self.DATA_BITS, num)
 
     def setMemory(self,address, data):
-        self.MM[address] = NBitInt(self.DATA_BITS, data)
+        self.MM.set(address, data)
     def getMemory(self, address):
-        return int(self.MM[address])
+        return self.MM.signed(address)
 
     def printRegisters(self, a=False, b=False, c=False, d=False, mdr=False, mar=False, mpc=False):
         s = ""
@@ -453,8 +418,29 @@ class MicroProgram(object):
         self.MPC = 0
         self.debug = False
         self.more_debug = False
+        self.words = None
+        self.cycles = None
         self.parse(userInput)
 
+    def getWords(self):
+        # Each microinstruction as a 22-bit int, control signal 1 in the highest bit. Built on
+        # first use; MPM must not change afterwards.
+        if self.words is None:
+            self.words = [int("".join(str(bit) for bit in ins), 2) for ins in self.MPM]
+        return self.words
+
+    def __getstate__(self):
+        # compiled cycles can't be pickled, they are rebuilt on first use
+        state = self.__dict__.copy()
+        state["cycles"] = None
+        return state
+
+    def getCycles(self):
+        # The compiled cycle of each MPM address, see MicroSim.compileCycle
+        if self.cycles is None:
+            self.cycles = [MicroSim.compileCycle(word) for word in self.getWords()]
+        return self.cycles
+
     def setCurrent(self, address):
         self.MPC = address
 
@@ -506,6 +492,209 @@ class MicroProgram(object):
             self.setCC(*nums)
             lineNum += 1
 
+MicroBatchResults = namedtuple("MicroBatchResults", "registers memory cycles errors")
+
+MICRO_REGISTERS = ("A", "B", "C", "D", "MDR", "MAR", "MPC")
+
+_microMachine = None
+_microAddresses = ()
+
+def _initMicroWorker(program, addresses, maxCycles=None, detectLoops=False):
+    global _microMachine, _microAddresses
+    _microMachine = MicroSim(program, quiet=True)
+    _microMachine.maxCycles = maxCycles
+    _microMachine.detectLoops = detectLoops
+    _microAddresses = addresses
+
+def _runMicroCase(case):
+    sim = _microMachine
+    try:
+        sim.resetRegisters()
+        sim.resetMemory()
+        sim.setABCD(case.get("A", 0), case.get("B", 0), case.get("C", 0), case.get("D", 0))
+        sim.setMDR(case.get("MDR", 0))
+        memory = case.get("memory", ())
+        for address, value in (memory.items() if hasattr(memory, "items") else memory):
+            sim.setMemory(address, value)
+        cycles = sim.execute()
+        return ([int(getattr(sim, register)) for register in MICRO_REGISTERS]
+                + [sim.getMemory(address) for address in _microAddresses]), cycles, None
+    except Exception as e:
+        return None, getattr(e, "cycles", 0), "%s: %s" % (type(e).__name__, e)
+
+def runMicroBatch(program, cases, readAddresses=(), processes=None, chunksize=4, maxCycles=100000, detectLoops=True):
+    # Runs one microprogram against many initial states. A case is a dict with any of the keys
+    # A, B, C, D, MDR (missing ones are 0) and memory, a dict or a list of (address, value)
+    # pairs. The result is columnar: registers[name][i] is the final value of a register after
+    # case i, memory[address][i] the final word at one of readAddresses and cycles[i] the cycle
+    # count. A case that raised has zero registers and its message in errors[i].
+    if isinstance(program, str):
+        program = MicroProgram(program)
+    addresses = tuple(readAddresses)
+    initArgs = (program, addresses, maxCycles, detectLoops)
+    if processes == 1:
+        _initMicroWorker(*initArgs)
+        results = [_runMicroCase(case) for case in cases]
+    else:
+        with multiprocessing.Pool(processes, _initMicroWorker, initArgs) as pool:
+            results = pool.map(_runMicroCase, cases, chunksize)
+    width = len(MICRO_REGISTERS) + len(addresses)
+    columns = [array("l", [0]) * len(results) for i in range(width)]
+    for i, (values, cycles, error) in enumerate(results):
+        if values is not None:
+            for column, value in zip(columns, values):
+                column[i] = value
+    registers = dict(zip(MICRO_REGISTERS, columns))
+    memory = dict(zip(addresses, columns[len(MICRO_REGISTERS):]))
+    cycles = array("l", [cycles for values, cycles, error in results])
+    errors = {i: error for i, (values, cycles, error) in enumerate(results) if error is not None}
+    return MicroBatchResults(registers, memory, cycles, errors)
+
+class VectorMicroSim:
+    # Runs one microprogram on many independent register/memory states (lanes) in lockstep using
+    # NumPy, like VectorMachineSim in computer.py. A-D, MDR and MAR are uint16 vectors holding the
+    # 16-bit (MAR 12-bit) patterns, MPC the 16-bit pattern of the next address and MM a
+    # lanes x 4096 uint16 matrix. Each cycle groups the running lanes by the microinstruction they
+    # are at and applies it to the whole group; the A zero / A negative inputs of clock4 are
+    # evaluated per lane, so lanes may branch apart. Values set from outside are taken modulo 2^16.
+    DATA_BITS = MicroSim.DATA_BITS
+    DATA_BIT_MASK = MicroSim.DATA_BIT_MASK
+    MAR_WIDTH = MicroSim.MAR_WIDTH
+    MIR_WIDTH = MicroSim.MIR_WIDTH
+    CC = MicroSim.CC
+    REGISTERS = ("A", "B", "C", "D", "MDR", "MAR")
+
+    # per-lane outcome codes in errors
+    ERROR_NONE = 0
+    ERROR_ADDRESS = 1 # MPC outside the microprogram memory
+    ERROR_NAMES = {ERROR_ADDRESS: "address out of range"}
+
+    def __init__(self, lanes, microProgram):
+        if numpy is None:
+            raise ImportError("VectorMicroSim requires NumPy")
+        self.lanes = lanes
+        self.words = numpy.array(microProgram.getWords(), numpy.int64)
+        self.resetRegisters()
+        self.resetMemory()
+
+    def resetRegisters(self):
+        for register in self.REGISTERS:
+            setattr(self, register, numpy.zeros(self.lanes, numpy.uint16))
+        self.MPC = numpy.zeros(self.lanes, numpy.int64)
+        self.cycles = numpy.zeros(self.lanes, numpy.int64)
+        self.halted = numpy.zeros(self.lanes, bool)
+        self.errors = numpy.zeros(self.lanes, numpy.int8)
+
+    def resetMemory(self):
+        self.MM = numpy.zeros((self.lanes, 4096), numpy.uint16)
+
+    def _lanes(self, values):
+        # values is one int for every lane or a sequence with one int per lane
+        return numpy.asarray(values, numpy.int64) & self.DATA_BIT_MASK
+
+    def setA(self, values):
+        self.A[:] = self._lanes(values)
+
+    def setB(self, values):
+        self.B[:] = self._lanes(values)
+
+    def setC(self, values):
+        self.C[:] = self._lanes(values)
+
+    def setD(self, values):
+        self.D[:] = self._lanes(values)
+
+    def setABCD(self, a, b, c, d):
+        self.setA(a)
+        self.setB(b)
+        self.setC(c)
+        self.setD(d)
+
+    def setMDR(self, values):
+        self.MDR[:] = self._lanes(values)
+
+    def setMemory(self, address, values):
+        self.MM[:, address] = self._lanes(values)
+
+    def getMemory(self, address):
+        return self.MM[:, address].view(numpy.int16).astype(numpy.int64)
+
+    def getRegister(self, name):
+        # signed values per lane as MicroSim gives them with int(); MAR is unsigned
+        if name == "MAR":
+            return self.MAR.astype(numpy.int64)
+        if name == "MPC":
+            return self._addresses(self.MPC)
+        return getattr(self, name).view(numpy.int16).astype(numpy.int64)
+
+    @staticmethod
+    def _addresses(mpc):
+        return numpy.where(mpc < 0x8000, mpc, mpc - 0x10000)
+
+    def running(self):
+        return ~self.halted & (self.errors == self.ERROR_NONE)
+
+    def execute(self, maxCycles=None):
+        # Cycles until every lane has reached a zero microinstruction or failed, or maxCycles
+        # cycles have been executed; lanes still running() afterwards hit the cycle limit.
+        words = self.words
+        size = len(words)
+        cycle = 0
+        while maxCycles is None or cycle < maxCycles:
+            lanes = numpy.flatnonzero(self.running())
+            if len(lanes) == 0:
+                break
+            for word, group in groupLanes(self, lanes, self._addresses(self.MPC[lanes]), size,
+                                          lambda lanes, addresses: words[addresses]):
+                self._executeCycle(word, group)
+                self.cycles[group] += 1
+            cycle += 1
+
+    def _executeCycle(self, word, lanes):
+        CC = self.CC
+        mask = self.DATA_BIT_MASK
+        targets = [register for cc, register in zip(range(9, 14), ("A", "B", "C", "D", "MDR")) if word & CC[cc]]
+        # clock1 and the ALU, skipped when nothing takes the result
+        if targets or word & CC[14]:
+            V1 = V2 = 0
+            for cc, register in zip(range(1, 5), ("A", "B", "C", "D")):
+                if word & CC[cc]:
+                    V2 = getattr(self, register)[lanes].astype(numpy.int64)
+            if word & CC[5]:
+                V1 = 1
+            if word & CC[6]:
+                V1 = self.MDR[lanes].astype(numpy.int64)
+            if word & CC[7]:
+                V1 = -V1
+            V3 = (V1 + V2) & mask
+            if word & CC[8]:
+                V3 = (V3 << 1) & mask
+            # clock2
+            for register in targets:
+                getattr(self, register)[lanes] = V3
+            if word & CC[14]:
+                self.MAR[lanes] = V3 & ((1 << self.MAR_WIDTH) - 1)
+        # clock3
+        if word & CC[15]:
+            self.MDR[lanes] = self.MM[lanes, self.MAR[lanes]]
+        if word & CC[16]:
+            self.MM[lanes, self.MAR[lanes]] = self.MDR[lanes]
+        # clock4
+        V1 = 0
+        if word & CC[17]:
+            V1 = 1
+        if word & CC[18]:
+            V1 = word >> (self.MIR_WIDTH - 8)
+        if word & CC[19]:
+            V1 = numpy.where(self.A[lanes] == 0, 1, 2)
+        if word & CC[20]:
+            V1 = numpy.where(self.A[lanes] >= 0x8000, 1, 2)
+        if word & CC[21]:
+            V1 = self.MDR[lanes].astype(numpy.int64) >> (self.DATA_BITS - 4)
+        V2 = self.MPC[lanes] if word & CC[22] else 0
+        # clock5
+        self.MPC[lanes] = (V1 + V2) & mask
+
 def debug():
     global mp
     mp.debug = True
@@ -0,0 +1,440 @@
+#encoding: utf-8
+# Fixed-width integers and the NumPy lane grouping shared by the simulators. When the simulators are
+# bundled into a single file, this file is placed in front of them.
+import operator
+import itertools
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # NBitArray falls back to plain Python loops
+
+class NBitInt:
+    __slots__ = ("value", "bits", "bitmask", "unsigned")
+    _bitmasks = {} # bits -> 2**bits-1, filled on first use of each width
+    _interned = {}
+
+    def __init__(self, bits, num=0, unsigned=False):
+        bitmask = NBitInt._bitmasks.get(bits)
+        if bitmask is None:
+            bitmask = NBitInt._bitmasks[bits] = 2**bits-1
+        self.bits = bits
+        self.bitmask = bitmask
+        self.unsigned = unsigned
+
+        if num < 0:
+            num = bitmask + 1 + num # two's complement, 2**bits - abs(num)
+        self.value = num
+
+    @staticmethod
+    def interned(bits, num=0, unsigned=False):
+        # Shared FrozenNBitInt for the value, e.g. for the cells of fresh memory
+        key = (bits, num, unsigned)
+        instance = NBitInt._interned.get(key)
+        if instance is None:
+            instance = NBitInt._interned[key] = FrozenNBitInt(bits, num, unsigned)
+        return instance
+
+    def __signBit(self):
+        if not self.unsigned:
+            return (self.value >> (self.bits-1)) & 1
+        return 0 # treat first bit as data bit
+
+    def isSigned(self):
+        return self.__signBit() != 0
+
+    def isZero(self):
+        return self.value == 0
+
+    def splitToArray(self, *args):
+        if sum(args) != self.bits:
+            raise ValueError("Invalid params: " + repr(args))
+        result = []
+        value = self.value
+        mask = self.bitmask
+        width = self.bits
+
+        cumulBits = 0
+        for bits in args:
+            num = (value << cumulBits) & mask #discard high order bits
+            num = num >> (width - bits)
+            cumulBits += bits
+            result.append(num)
+
+        return result
+
+    def copy(self):
+        if not 0 <= self.value <= self.bitmask:
+            return NBitInt(self.bits,int(self),self.unsigned)
+        # in range, NBitInt(self.bits, int(self), self.unsigned) reproduces value exactly
+        clone = NBitInt.__new__(NBitInt)
+        clone.value = self.value
+        clone.bits = self.bits
+        clone.bitmask = self.bitmask
+        clone.unsigned = self.unsigned
+        return clone
+
+#OPERATORS
+#ARITHMETIC
+    @staticmethod
+    def __add_impl(x, y, bitmask):
+        return (x+y) & bitmask
+
+    def __add__(self, other):
+        other = int(other)
+        return NBitInt(self.bits,
+                       NBitInt.add_impl(self.value, other.value, self.bitmask),
+                       unsigned=self.unsigned)
+
+    def __iadd__(self, other):
+        self.value = (self.value + int(other)) & self.bitmask
+        return self
+
+    @staticmethod
+    def __subtract_impl(lhs, rhs):
+        rhs = -rhs
+        result = lhs + rhs
+        return result
+
+    def __sub__(self, other):
+        return NBitInt.subtract_impl(self, other)
+
+    def __isub__(self, other):
+        if isinstance(other, NBitInt) and other.bits < self.bits:
+            # the negation wraps at the narrower width, which a plain subtraction would not
+            other = -other
+            self += other
+            return self
+        self.value = (self.value - int(other)) & self.bitmask
+        return self
+
+    @staticmethod
+    def __multiply_impl(bitmask, x, y):
+        return (x*y) & bitmask
+
+    def __mul__(self, other):
+        other = int(other)
+        return NBitInt(self.bits,
+                       NBitInt.multiply_impl(self.bitmask, self.value, other),
+                       unsigned=self.unsigned)
+
+    def __imul__(self, other):
+        other = int(other)
+        self.value = NBitInt.__multiply_impl(self.bitmask, self.value, other)
+        return self
+
+    @staticmethod
+    def __complement_impl(bits, y):
+        return 2**bits - y
+
+
+    def __neg__(self):
+        value = NBitInt.__complement_impl(self.bits, self.value)
+        return NBitInt(self.bits, value, unsigned=self.unsigned)
+
+    @staticmethod
+    def __divide_impl(x, y):
+        x,y = map(int, (x,y))
+        result = x//y
+        return result
+
+    def __floordiv__(self, other):
+        value = NBitInt.divide_impl(self.value, other)
+        return NBitInt(self.bits, value, unsigned=self.unsigned)
+
+    def __ifloordiv__(self, other):
+        value = NBitInt.__divide_impl(self, other)
+        if value < 0:
+            value = NBitInt.__complement_impl(self.bits, abs(value))
+        self.value = value
+        return self
+
+#END ARITHMETIC OPERATORS
+
+#SHIFT OPERATORS
+
+    def __lshift_impl(self, num):
+        return (self.value << num) & self.bitmask
+
+    def __lshift__(self, num):
+        return NBitInt(self.bits, self.__lshift_impl(num), unsigned=self.unsigned)
+
+    def __ilshift__(self, num):
+        self.value = (self.value << num) & self.bitmask
+        return self
+
+    def __rshift__(self, num):
+        return NBitInt(self.bits, self.value >> num, unsigned=self.unsigned)
+
+    def __irshift__(self, num):
+        self.value >>= num
+        return self
+
+    #If one of the operands is unsigned, the result will also be. The result has as many bits as the largest operand
+    @staticmethod
+    def binop_impl(num1, num2, oper):
+        isNbit = [isinstance(x, NBitInt) for x in [num1, num2]]
+        bits = 16
+        unsigned = True
+        val1 = val2 = 0
+        if all(isNbit):
+            bits = max(num1.bits, num2.bits)
+            unsigned = num1.unsigned | num2.unsigned
+            val1, val2 = num1.value, num2.value
+        elif any(isNbit):
+            if isNbit[1]:
+                num1,num2 = num2,num1 #swap
+            val1, val2 = num1.value, num2
+            bits = num1.bits
+            unsigned = num1.unsigned
+        val = oper(val1, val2)
+        return NBitInt(bits, num=val, unsigned=unsigned)
+
+    def __and__(self, other):
+        return NBitInt.binop_impl(self, other, operator.__and__)
+
+    def __iand__(self, other):
+        self.value = NBitInt.binop_impl(self, other, operator.__and__).value
+        return self
+
+    def __or__(self, other):
+        return NBitInt.binop_impl(self, other, operator.__or__)
+
+    def __ior__(self, other):
+        self.value = NBitInt.binop_impl(self, other, operator.__or__).value
+        return self
+
+    def __xor__(self, other):
+        return NBitInt.binop_impl(self, other, operator.__xor__)
+
+    def __ixor__(self, other):
+        self.value = NBitInt.binop_impl(self, other, operator.__ixor__).value
+        return self
+
+#Unary operators
+    def __invert__(self):
+        return NBitInt(self.bits, num=(self.bitmask - self.value), unsigned=self.unsigned)
+
+    def __pos__(self):
+        return self.copy()
+#End unary operators
+
+#Built-in functions
+    def __abs__(self):
+        return NBitInt(self.bits, num=abs(self.value))
+
+    def __int__(self):
+        if not self.unsigned and (self.value >> (self.bits-1)) & 1:
+            return self.value - self.bitmask - 1
+        return self.value
+
+    def __oct__(self):
+        return oct(self.value)
+
+    def __hex__(self):
+        return hex(self.value)
+
+    #Not actually built-in, but it fits here
+    def bin(self):
+        return bin(self.value)
+
+    def __str__(self):
+        return str(int(self))
+
+
+class FrozenNBitInt(NBitInt):
+    # Immutable NBitInt that can be shared: attributes can't be assigned and the in-place
+    # operators (+=, <<= ...) return a new NBitInt instead of changing this one.
+    __slots__ = ()
+
+    def __init__(self, bits, num=0, unsigned=False):
+        value = NBitInt(bits, num, unsigned)
+        for name in NBitInt.__slots__:
+            object.__setattr__(self, name, getattr(value, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenNBitInt is immutable")
+
+    def __reduce__(self):
+        return FrozenNBitInt, (self.bits, self.value, self.unsigned)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+def _copyInPlace(name):
+    def operation(self, other):
+        # on an exact clone, copy() would normalise values outside the range
+        clone = NBitInt.__new__(NBitInt)
+        for slot in NBitInt.__slots__:
+            setattr(clone, slot, getattr(self, slot))
+        return getattr(clone, name)(other)
+    operation.__name__ = name
+    return operation
+
+for _name in ("__iadd__", "__isub__", "__imul__", "__ifloordiv__", "__ilshift__", "__irshift__",
+              "__iand__", "__ior__", "__ixor__"):
+    setattr(FrozenNBitInt, _name, _copyInPlace(_name))
+
+
+class NBitArray(array):
+    # Fixed-width words in one contiguous buffer, stored unsigned and masked to bits. Indexing gives
+    # the raw word as an int; signed() sign-extends it and nbit() wraps it in an NBitInt. The
+    # elementwise operations work in place and use NumPy when it is installed. Slicing returns a
+    # plain array of the raw words (__getitem__ is left to array for speed); use copy() or
+    # fromBytes() for an NBitArray.
+    TYPECODES = ((8, "B"), (16, "H"), (32, "I"), (64, "Q"))
+
+    def __new__(cls, bits, size=0):
+        for width, typecode in cls.TYPECODES:
+            if bits <= width:
+                break
+        else:
+            raise ValueError("Invalid bit width: " + repr(bits))
+        self = array.__new__(cls, typecode, bytes(size * width // 8))
+        self.bits = bits
+        self.bitmask = 2**bits-1
+        self.signBit = 1 << (bits-1)
+        return self
+
+    @classmethod
+    def fromBytes(cls, bits, data):
+        words = cls(bits)
+        words.frombytes(data)
+        return words
+
+    @classmethod
+    def fromValues(cls, bits, values):
+        words = cls(bits)
+        bitmask = words.bitmask
+        words.extend(int(value) & bitmask for value in values)
+        return words
+
+    def copy(self):
+        return self.fromBytes(self.bits, self.tobytes())
+
+    # array's own copy and pickle support would rebuild without bits
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce_ex__(self, protocol):
+        return self.fromBytes, (self.bits, self.tobytes())
+
+    def set(self, index, value):
+        self[index] = int(value) & self.bitmask
+
+    def signed(self, index):
+        word = self[index]
+        return word - ((word & self.signBit) << 1)
+
+    def nbit(self, index, unsigned=False):
+        return NBitInt(self.bits, self[index], unsigned)
+
+    def __view(self):
+        return numpy.frombuffer(self, numpy.dtype(self.typecode))
+
+    def toSigned(self):
+        if numpy is not None:
+            words = self.__view().astype(numpy.int64)
+            return (words - ((words & self.signBit) << 1)).tolist()
+        signBit = self.signBit
+        return [word - ((word & signBit) << 1) for word in self]
+
+    def __operands(self, other):
+        # other is one value for every word or a sequence with one value per word
+        bitmask = self.bitmask
+        if isinstance(other, (int, NBitInt)):
+            return itertools.repeat(int(other) & bitmask, len(self))
+        if len(other) != len(self):
+            raise ValueError("Length mismatch: %i != %i" % (len(other), len(self)))
+        return (int(value) & bitmask for value in other)
+
+    def __numpyOperand(self, other):
+        if isinstance(other, (int, NBitInt)):
+            return int(other) & self.bitmask
+        if len(other) != len(self):
+            raise ValueError("Length mismatch: %i != %i" % (len(other), len(self)))
+        return (numpy.asarray(other, numpy.int64) & self.bitmask).astype(self.__view().dtype)
+
+    def add(self, other):
+        if numpy is not None:
+            words = self.__view()
+            words += self.__numpyOperand(other)
+            words &= self.bitmask
+            return self
+        bitmask = self.bitmask
+        self[:] = array(self.typecode, [(word + value) & bitmask for word, value in zip(self, self.__operands(other))])
+        return self
+
+    def sub(self, other):
+        if numpy is not None:
+            words = self.__view()
+            words -= self.__numpyOperand(other)
+            words &= self.bitmask
+            return self
+        bitmask = self.bitmask
+        self[:] = array(self.typecode, [(word - value) & bitmask for word, value in zip(self, self.__operands(other))])
+        return self
+
+    def shiftLeft(self, num):
+        if numpy is not None:
+            words = self.__view()
+            words <<= num
+            words &= self.bitmask
+            return self
+        bitmask = self.bitmask
+        self[:] = array(self.typecode, [(word << num) & bitmask for word in self])
+        return self
+
+    def shiftRight(self, num):
+        if numpy is not None:
+            words = self.__view()
+            words >>= num
+            return self
+        self[:] = array(self.typecode, [word >> num for word in self])
+        return self
+
+    def snapshot(self):
+        return self.tobytes()
+
+    def restore(self, data):
+        # in place, so references to this array stay valid
+        memoryview(self).cast("B")[:] = data
+
+    def diff(self, other):
+        # indices of the words that differ from other, an NBitArray or snapshot() bytes of the same length
+        if isinstance(other, (bytes, bytearray)):
+            other = self.fromBytes(self.bits, other)
+        if len(other) != len(self):
+            raise ValueError("Length mismatch: %i != %i" % (len(other), len(self)))
+        if self.tobytes() == other.tobytes():
+            return []
+        if numpy is not None:
+            return numpy.flatnonzero(self.__view() != numpy.frombuffer(other, self.__view().dtype)).tolist()
+        return [index for index, (word, otherWord) in enumerate(zip(self, other)) if word != otherWord]
+
+def groupLanes(sim, lanes, addresses, size, fetch):
+    # Lane grouping of the NumPy lockstep engines (VectorMachineSim, VectorMicroSim). lanes are the
+    # running lanes and addresses the signed address each is at, valid from -size to size - 1;
+    # fetch(lanes, addresses) gives the words there. Lanes outside get sim.ERROR_ADDRESS and lanes
+    # at a zero word are halted. Returns the rest as (word, lanes) pairs, one per distinct word.
+    outside = (addresses < -size) | (addresses >= size)
+    if outside.any():
+        sim.errors[lanes[outside]] = sim.ERROR_ADDRESS
+        lanes, addresses = lanes[~outside], addresses[~outside]
+    words = fetch(lanes, addresses)
+    zero = words == 0
+    sim.halted[lanes[zero]] = True
+    lanes, words = lanes[~zero], words[~zero]
+    if len(words) == 0:
+        return []
+    if (words == words[0]).all():
+        return [(int(words[0]), lanes)]
+    uniqueWords, inverse = numpy.unique(words, return_inverse=True)
+    return [(word, lanes[inverse == i]) for i, word in enumerate(uniqueWords.tolist())]